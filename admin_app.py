@@ -3,13 +3,24 @@
 # 学校用にダッシュボード / ヒートマップ / 相談トリアージを提供する専用アプリ。
 
 from __future__ import annotations
+from abc import ABC, abstractmethod
 from datetime import datetime, timezone, timedelta, date
-from typing import List, Dict, Any, Optional, Tuple
+from typing import Callable, List, Dict, Any, Optional, Tuple
 
 import streamlit as st
 import pandas as pd
 import altair as alt
-import unicodedata, os, json, hmac, hashlib, re
+import unicodedata, os, json, hmac, hashlib, re, threading, bisect
+from collections import OrderedDict
+
+from risk import message_priority_batch, RISK_CLASSIFIER_VERSION
+from storage import AlreadyExists, Doc, FirestoreStorage, Write, local_storage_from_env
+
+# キャッシュした DataFrame を全セッションでそのまま共有するため、Copy-on-Write を前提にする
+# （切り出しはビューのまま、どこかのページが列を足したり書き換えたりしたときだけ複製される）。
+# pandas 3 以降は常に有効
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 # ================== ページ設定 ==================
 st.set_page_config(
@@ -20,22 +31,25 @@ st.set_page_config(
 )
 
 # ================== Firestore 接続 ==================
+# DB は storage.Storage（環境変数 WITHYOU_STORAGE でメモリ / SQLite にも差し替えられる）
 FIRESTORE_ENABLED = True
 try:
-    from google.cloud import firestore
-    import google.oauth2.service_account as service_account
-
-    @st.cache_resource(show_spinner=False)
-    def firestore_client():
-        creds = service_account.Credentials.from_service_account_info(
-            st.secrets["FIREBASE_SERVICE_ACCOUNT"]
-        )
-        return firestore.Client(
-            project=st.secrets["FIREBASE_SERVICE_ACCOUNT"]["project_id"],
-            credentials=creds,
-        )
+    DB = local_storage_from_env()
+    if DB is None:
+        from google.cloud import firestore
+        import google.oauth2.service_account as service_account
+
+        @st.cache_resource(show_spinner=False)
+        def firestore_storage() -> FirestoreStorage:
+            creds = service_account.Credentials.from_service_account_info(
+                st.secrets["FIREBASE_SERVICE_ACCOUNT"]
+            )
+            return FirestoreStorage(firestore.Client(
+                project=st.secrets["FIREBASE_SERVICE_ACCOUNT"]["project_id"],
+                credentials=creds,
+            ))
 
-    DB = firestore_client()
+        DB = firestore_storage()
 except Exception:
     FIRESTORE_ENABLED = False
     DB = None
@@ -58,57 +72,370 @@ def hmac_sha256_hex(secret: str, data: str) -> str:
     return hmac.new(secret.encode("utf-8"), data.encode("utf-8"), hashlib.sha256).hexdigest()
 
 
-def payload_series(v: dict, key: str, default=None):
-    if not isinstance(v, dict):
-        return default
-    return (v.get("payload", {}) or {}).get(key, default)
-
-
-@st.cache_data(show_spinner=False, ttl=60)
-def fetch_rows_cached(coll: str, gid: Optional[str], days: int = 60) -> List[dict]:
-    """過去days日のデータを取得（ts降順）。インデックスが無くても動くフォールバック。"""
-    if not FIRESTORE_ENABLED or DB is None:
-        return []
-    q = DB.collection(coll)
-    if gid:
-        q = q.where("group_id", "==", gid)
-    since = now_utc() - timedelta(days=days)
+FETCH_PAGE_SIZE = 500
+REFRESH_SEC = 60
+# 画面が見る一番長い期間。(コレクション, グループ) ごとにこの期間を 1 回だけ読み、
+# それより短い期間（ヒートマップのスライダーなど）はメモリ上で切り出して返す
+MAX_WINDOW_DAYS = 60
+REFRESH_RETRY_SEC = 15  # 読み込みに失敗したあと、次に試すまでの間隔
+# 差分取得は保存先が付けた committed_at で進める。同時にコミットされた行が読み込みの後に
+# 見えるようになっても取りこぼさないための重なり幅（committed_at の無い古い行だけのときは ts で使う）
+REFRESH_OVERLAP = timedelta(minutes=5)
+
+
+# ================== 読み込むフィールド（使う側ごとの射影） ==================
+# 集計に要るのは数値と選択肢だけ。memo・相談本文・ハンドル・user_key は読み込まない
+# （帯域と行キャッシュのメモリを減らし、自由記述を集計用のキャッシュに置かない）。
+# ts・group_id はカーソルと絞り込みに使うので必ず入れる。
+SHARE_FIELDS = (
+    "ts", "group_id",
+    "payload.mood", "payload.sleep_hours", "payload.sleep_quality", "payload.body",
+)
+CONSULT_FIELDS = ("ts", "group_id", "committed_at", "topics", "intent", "anonymous", "msg_priority", "risk_version")
+CONSULT_SHOW_ROWS = 100  # 相談ページで本文まで読む件数（新しい順）
+BODY_CACHE_MAX = 1000
+
+
+def stream_window(
+    coll: str, where: list, since: datetime, select: Optional[Tuple[str, ...]] = None, field: str = "ts"
+) -> List[dict]:
+    """field >= since の範囲を start_after カーソルでページングしながら最後まで読む（field 昇順）。"""
+    where = where + [(field, ">=", since)]
+    out: List[dict] = []
+    last = None
+    while True:
+        docs = DB.query(coll, where=where, order_by=field, limit=FETCH_PAGE_SIZE, start_after=last, select=select)
+        out.extend(d.data | {"id": d.id} for d in docs)
+        if len(docs) < FETCH_PAGE_SIZE:
+            return out
+        last = docs[-1]
+
+
+def query_window(
+    coll: str, gid: Optional[str], since: datetime, select: Optional[Tuple[str, ...]] = None, field: str = "ts"
+) -> List[dict]:
     try:
-        docs = list(q.order_by("ts", direction="DESCENDING").limit(2000).stream())
+        return stream_window(coll, [("group_id", "==", gid)] if gid else [], since, select, field)
     except Exception:
-        docs = list(q.limit(2000).stream())
-    rows = [d.to_dict() for d in docs]
-    out = []
-    for r in rows:
-        ts = r.get("ts")
-        if isinstance(ts, datetime):
-            if ts >= since:
-                out.append(r)
+        # (group_id, field) の複合インデックスが無い場合：field 単体で読んで Python 側で絞り込む
+        rows = stream_window(coll, [], since, select, field)
+        if gid:
+            rows = [r for r in rows if r.get("group_id") == gid]
+        return rows
+
+
+class SharedWindow(ABC):
+    """全セッションで共有する読み込み済みデータ（stale-while-revalidate）。
+
+    REFRESH_SEC を過ぎたら、最初に気づいたセッションがバックグラウンドで 1 回だけ読み直しを始め、
+    その間も・読み直しに失敗している間も、手元のデータ（as_of 時点）をそのまま返す。
+    まだ 1 度も読めていないときだけ、進行中の読み込みの終わりを待つ（同時に来ても読み込みは 1 回）。
+    """
+
+    def __init__(self):
+        self.as_of: Optional[datetime] = None  # 最後に読み込みに成功した時刻
+        self.error: Optional[BaseException] = None  # 直近の読み込みが失敗していればその例外
+        self.failed_at: Optional[datetime] = None
+        self.lock = threading.Lock()  # データの差し替えと切り出し用
+        self.frame = pd.DataFrame()  # 読み込んだ行を列ごとにまとめたもの（読み込みのたびに作り直す・書き換えない）
+        self._flight_lock = threading.Lock()
+        self._inflight: Optional[threading.Thread] = None
+
+    @abstractmethod
+    def fetch(self):
+        """バックエンドから読む（ロックの外で呼ばれる）。結果は apply に渡る。"""
+
+    @abstractmethod
+    def apply(self, result) -> List[dict]:
+        """fetch の結果を反映し、今の行を返す（self.lock を保持して呼ばれる）。"""
+
+    def to_frame(self, rows: List[dict]) -> pd.DataFrame:
+        """行から共有用の DataFrame を作る（ロックの外で呼ばれる）。"""
+        return pd.DataFrame()
+
+    def _refresh(self):
+        try:
+            result = self.fetch()
+            with self.lock:
+                rows = self.apply(result)
+            # 組み立てはロックの外で（その間も前の frame を返せる）
+            frame = self.to_frame(rows)
+            with self.lock:
+                self.frame = frame
+                self.as_of = now_utc()
+                self.error = None
+        except Exception as e:
+            self.error = e
+            self.failed_at = now_utc()
+        finally:
+            with self._flight_lock:
+                self._inflight = None
+
+    def ensure_fresh(self):
+        now = now_utc()
+        with self._flight_lock:
+            fresh = self.as_of is not None and (now - self.as_of).total_seconds() < REFRESH_SEC
+            # つながらない間は REFRESH_RETRY_SEC おきにだけ試す
+            backing_off = self.failed_at is not None and (now - self.failed_at).total_seconds() < REFRESH_RETRY_SEC
+            if self._inflight is None and not fresh and not (backing_off and self.as_of is not None):
+                self._inflight = threading.Thread(target=self._refresh, name="withyou-admin-refresh", daemon=True)
+                self._inflight.start()
+            flight = self._inflight
+        if self.as_of is None and flight is not None:
+            flight.join()
+        if self.as_of is None:
+            raise self.error or RuntimeError("データを読み込めませんでした")
+
+
+class IncrementalRows(SharedWindow):
+    """(coll, gid, fields) ごとに直近 MAX_WINDOW_DAYS 日の読み込み済みの行を保持し、差分だけ取りに行く。
+
+    ts は書いた端末の時刻なので、スプールで遅れて届いた行は ts が古い。差分は committed_at
+    （保存先がコミットした時刻）の最高水位から読み、ts の範囲は手元で絞る。committed_at を入れない
+    書き込み（入れる前の生徒アプリなど）もあるので、ts の最高水位からの読み込みも毎回行い、doc ID でまとめる。
+    """
+
+    def __init__(
+        self,
+        coll: str,
+        gid: Optional[str],
+        fields: Optional[Tuple[str, ...]] = None,
+        make_frame: Optional[Callable[[List[dict]], pd.DataFrame]] = None,
+    ):
+        super().__init__()
+        self.coll = coll
+        self.gid = gid
+        self.days = MAX_WINDOW_DAYS
+        self.fields = fields
+        self.make_frame = make_frame
+        self.rows: List[dict] = []  # ts 昇順
+        self.ids: set = set()
+        self.high_water: Optional[datetime] = None  # ts の最高水位
+        self.committed_high: Optional[datetime] = None  # committed_at の最高水位
+
+    def _merge(self, new_rows: List[dict]):
+        committed = [r["committed_at"] for r in new_rows if isinstance(r.get("committed_at"), datetime)]
+        if committed:
+            self.committed_high = max([self.committed_high or committed[0], *committed])
+        fresh = [r for r in new_rows if r.get("id") not in self.ids]
+        if not fresh:
+            return
+        self.ids.update(r.get("id") for r in fresh)
+        if self.rows and fresh[0]["ts"] < self.rows[-1]["ts"]:
+            self.rows = sorted(self.rows + fresh, key=lambda r: r["ts"])
         else:
-            out.append(r)
+            self.rows = self.rows + fresh  # 切り出し済みのリストを書き換えない
+        self.high_water = self.rows[-1]["ts"]
+
+    def _evict(self, since: datetime):
+        cut = bisect.bisect_left(self.rows, since, key=lambda r: r["ts"])
+        if cut:
+            for r in self.rows[:cut]:
+                self.ids.discard(r.get("id"))
+            self.rows = self.rows[cut:]
+
+    def fetch(self):
+        since = now_utc() - timedelta(days=self.days)
+        start = since if self.high_water is None else max(since, self.high_water - REFRESH_OVERLAP)
+        rows = {r["id"]: r for r in query_window(self.coll, self.gid, start, self.fields)}
+        if self.committed_high is not None:
+            late = query_window(self.coll, self.gid, self.committed_high - REFRESH_OVERLAP, self.fields, "committed_at")
+            rows.update((r["id"], r) for r in late if isinstance(r.get("ts"), datetime) and r["ts"] >= since)
+        return since, sorted(rows.values(), key=lambda r: r["ts"])
+
+    def apply(self, result):
+        since, rows = result
+        self._merge(rows)
+        self._evict(since)
+        return self.rows
+
+    def to_frame(self, rows: List[dict]) -> pd.DataFrame:
+        return self.make_frame(rows) if self.make_frame is not None else pd.DataFrame()
+
+    def get_frame(self, days: int) -> pd.DataFrame:
+        """直近 days 日ぶんの frame（ts昇順）。複製ではなく共有の frame の切り出し（ビュー）。"""
+        self.ensure_fresh()
+        with self.lock:
+            frame = self.frame
+        if frame.empty:
+            return frame
+        return frame.iloc[frame["ts"].searchsorted(pd.Timestamp(now_utc() - timedelta(days=days))):]
+
+
+@st.cache_resource(show_spinner=False)
+def row_cache(coll: str, gid: Optional[str], fields: Optional[Tuple[str, ...]]) -> IncrementalRows:
+    return IncrementalRows(coll, gid, fields, FRAME_BUILDERS.get(coll))
+
+
+def fetch_consult_df(gid: Optional[str], days: int = 60) -> pd.DataFrame:
+    """過去days日の相談（本文なし・ts昇順）の DataFrame。全セッション共有の frame のビューなので書き換えないこと。"""
+    if not FIRESTORE_ENABLED or DB is None:
+        return pd.DataFrame()
+    return row_cache("consult_msgs", gid, CONSULT_FIELDS).get_frame(min(days, MAX_WINDOW_DAYS))
+
+
+class BodyCache:
+    """相談の doc ID → 本文（最大 BODY_CACHE_MAX 件・古く使ったものから捨てる）。
+    相談ページで表示した行と、判定が要った行の分だけが入る。スクリプトと読み直しのスレッドから使うのでロック付き。"""
+
+    def __init__(self, max_entries: int = BODY_CACHE_MAX):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, str]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, ids: List[str]) -> Dict[str, str]:
+        """ids のうち持っている分を返し、最近使ったことにする。"""
+        with self.lock:
+            hits = {}
+            for i in ids:
+                if i in self.entries:
+                    self.entries.move_to_end(i)
+                    hits[i] = self.entries[i]
+            return hits
+
+    def put(self, bodies: Dict[str, str]):
+        with self.lock:
+            for i, body in bodies.items():
+                self.entries[i] = body
+                self.entries.move_to_end(i)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+@st.cache_resource(show_spinner=False)
+def body_cache() -> BodyCache:
+    return BodyCache()
+
+
+def fetch_bodies(ids: List[str]) -> Dict[str, str]:
+    """相談本文を doc ID で読む（message だけの射影・1 回の一括取得）。読んだことのある本文は再利用する。
+    doc が見つからない ID は結果に入らない。"""
+    cache = body_cache()
+    out = cache.take([i for i in ids if i])
+    missing = list(dict.fromkeys(i for i in ids if i and i not in out))
+    if missing:
+        found = DB.get_many([f"consult_msgs/{i}" for i in missing], select=["message"])
+        fresh = {
+            i: (found[f"consult_msgs/{i}"] or {}).get("message", "")
+            for i in missing
+            if found[f"consult_msgs/{i}"] is not None
+        }
+        cache.put(fresh)
+        out.update(fresh)
     return out
 
 
-def classify_priority_by_message(msg: str) -> str:
-    if not msg:
-        return "low"
-    text = str(msg)
-    hi_kw = ["死にたい", "自殺", "消えたい", "殺", "希死", "虐待", "暴力", "首を", "リスカ"]
-    mid_kw = ["眠れない", "寝れない", "吐き気", "食欲", "不安", "落ち込", "つらい", "しんど"]
-    for k in hi_kw:
-        if k in text:
-            return "urgent"
-    for k in mid_kw:
-        if k in text:
-            return "medium"
-    return "low"
+# ================== 日次ロールアップ ==================
+# 生徒アプリが school_share の書き込みと同時に Increment で加算している (group_id, 日) 単位の集計
+ROLLUP_COLL = "share_daily"
+LOCAL_TZ = timezone(timedelta(hours=9))  # 学校の「1日」は日本時間で区切る
+
+
+def local_day(ts: datetime) -> str:
+    return ts.astimezone(LOCAL_TZ).strftime("%Y-%m-%d")
+
+
+class RollupWindow(SharedWindow):
+    """gid ごとに直近 MAX_WINDOW_DAYS 日の日次ロールアップを frame で持つ（day 昇順）。
+    ロールアップは Increment で書き換わるので差分ではなく REFRESH_SEC ごとに読み直す。"""
+
+    def __init__(self, gid: Optional[str]):
+        super().__init__()
+        self.gid = gid
+
+    def fetch(self):
+        since_day = local_day(now_utc() - timedelta(days=MAX_WINDOW_DAYS))
+        try:
+            where = [("group_id", "==", self.gid)] if self.gid else []
+            rows = [d.data for d in DB.query(ROLLUP_COLL, where=where + [("day", ">=", since_day)])]
+        except Exception:
+            # (group_id, day) の複合インデックスが無い場合
+            rows = [d.data for d in DB.query(ROLLUP_COLL, where=[("day", ">=", since_day)])]
+            rows = [r for r in rows if not self.gid or r.get("group_id") == self.gid]
+        return sorted(rows, key=lambda r: r.get("day", ""))
+
+    def apply(self, result):
+        return result  # 行は持たず frame だけを残す
+
+    def to_frame(self, rows: List[dict]) -> pd.DataFrame:
+        return make_rollup_df(rows)
+
+    def get_frame(self, days: int) -> pd.DataFrame:
+        """直近 days 日ぶんの frame（day昇順）のビュー。"""
+        self.ensure_fresh()
+        with self.lock:
+            frame = self.frame
+        if frame.empty:
+            return frame
+        return frame.iloc[frame["day"].searchsorted(local_day(now_utc() - timedelta(days=days))):]
+
+
+@st.cache_resource(show_spinner=False)
+def rollup_window(gid: Optional[str]) -> RollupWindow:
+    return RollupWindow(gid)
+
+
+def fetch_rollup_df(gid: Optional[str], days: int = 60) -> pd.DataFrame:
+    """過去days日の日次ロールアップ（day昇順）の DataFrame。全セッション共有の frame のビューなので書き換えないこと。"""
+    if not FIRESTORE_ENABLED or DB is None:
+        return pd.DataFrame()
+    return rollup_window(gid).get_frame(min(days, MAX_WINDOW_DAYS))
+
+
+def data_as_of_caption(*windows: SharedWindow):
+    """表示しているデータがいつ時点のものかを出す（つながらず古いデータのままなら注意として）。"""
+    loaded = [w for w in windows if w.as_of is not None]
+    if not loaded:
+        return
+    as_of = min(w.as_of for w in loaded).astimezone(LOCAL_TZ).strftime("%m/%d %H:%M:%S")
+    if any(w.error is not None for w in loaded):
+        st.warning(f"データベースに接続できないため、{as_of} 時点のデータを表示しています。")
+    else:
+        st.caption(f"🕒 {as_of} 時点のデータ")
+
+
+def rebuild_rollups(gid: Optional[str], days: int = 60) -> int:
+    """school_share の生データから日次ロールアップを作り直す（ロールアップ導入前のデータ用・上書き）。
+    今日（日本時間）の doc は生徒アプリが Increment で加算している最中なので、上書きせずに残す。"""
+    today = now_utc().astimezone(LOCAL_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = today - timedelta(days=days)
+    df = make_share_df(query_window("school_share", gid, start, SHARE_FIELDS))
+    if not df.empty:
+        df = df[df["ts"] < pd.Timestamp(today)]
+    if df.empty:
+        return 0
+    df["day"] = df["ts"].dt.tz_convert(LOCAL_TZ).dt.strftime("%Y-%m-%d")
+    agg = (
+        df.groupby(["group_id", "day"], observed=True)
+        .agg(
+            n=("mood", "size"),
+            low=("is_low", "sum"),
+            has_body=("has_body", "sum"),
+            sleep_sum=("sleep_hours", "sum"),
+        )
+        .reset_index()
+    )
+    acc = {
+        f"{r['group_id']}_{r['day']}": {
+            "group_id": r["group_id"],
+            "day": r["day"],
+            "n": int(r["n"]),
+            "low": int(r["low"]),
+            "has_body": int(r["has_body"]),
+            "sleep_sum": float(r["sleep_sum"]),
+        }
+        for r in agg.to_dict("records")
+    }
+
+    items = list(acc.items())
+    for i in range(0, len(items), 500):
+        DB.commit([Write("set", f"{ROLLUP_COLL}/{rid}", doc) for rid, doc in items[i : i + 500]])
+    rollup_window.clear()
+    return len(items)
 
 
 # ================== スタイル ==================
-def inject_css():
-    st.markdown(
-        """
-<style>
+ADMIN_CSS = """
 html, body, .stApp{
   background: radial-gradient(circle at 0% 0%, #101a33, #050b18 55%, #020511 100%);
   color:#f5f7ff;
@@ -190,63 +517,143 @@ section[data-testid="stSidebar"] .block-container{
 .dataframe tbody tr:nth-child(even){
   background:rgba(255,255,255,0.01);
 }
-</style>
-""",
-        unsafe_allow_html=True,
-    )
+"""
+
+
+def minify_css(css: str) -> str:
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+
+@st.cache_resource(show_spinner=False)
+def style_tag(css: str) -> str:
+    """最小化した <style> タグ。CSS の内容（のハッシュ）ごとにプロセスで 1 回だけ作る。"""
+    return f"<style>{minify_css(css)}</style>"
+
+
+def inject_css():
+    st.markdown(style_tag(ADMIN_CSS), unsafe_allow_html=True)
 
 
 inject_css()
 
 # ================== ダッシュボードページ ==================
+# 集計用の DataFrame は行ごとの dict を作らず、取得した doc から列ごとに組み立てる。
+# 種類の少ない列はカテゴリ型、ID などの文字列は Arrow の文字列型（pyarrow が無い環境では pandas の文字列型）。
+try:
+    import pyarrow  # noqa: F401
+    STR_DTYPE = pd.StringDtype("pyarrow")
+except ImportError:
+    STR_DTYPE = pd.StringDtype()
+
+
+def body_flag(bodies: pd.Series) -> pd.Series:
+    """「なし」以外の体調の項目が 1 つでもあれば 1（リストを explode して行番号ごとに any）。"""
+    items = bodies.explode()
+    return (items.notna() & items.ne("なし")).groupby(level=0).any().astype(int)
+
+
 def make_share_df(rows: List[dict]) -> pd.DataFrame:
     if not rows:
         return pd.DataFrame()
-    df = pd.DataFrame(
-        [
-            {
-                "ts": r.get("ts"),
-                "group_id": r.get("group_id", ""),
-                "mood": payload_series(r, "mood"),
-                "sleep_hours": payload_series(r, "sleep_hours"),
-                "sleep_quality": payload_series(r, "sleep_quality"),
-                "body": payload_series(r, "body", []),
-            }
-            for r in rows
-        ]
-    )
-    # 🔧 ここが今回の修正ポイント
-    # すべての ts を「UTC として解釈」し、その上で .dt.date を取るだけにする
-    df["ts"] = pd.to_datetime(df["ts"], utc=True, errors="coerce")
-    df["date"] = df["ts"].dt.date
-    df["has_body"] = df["body"].apply(
-        lambda x: int(any((b != "なし") for b in (x or [])))
+    top = pd.DataFrame(rows, columns=["ts", "group_id", "payload"])
+    pay = pd.DataFrame(
+        [p if isinstance(p, dict) else {} for p in top["payload"]],
+        columns=["mood", "sleep_hours", "sleep_quality", "body"],
     )
-    df["is_low"] = (df["mood"] == "😟").astype(int)
+    # すべての ts を「UTC として解釈」し、その上で .dt.date を取る
+    ts = pd.to_datetime(top["ts"], utc=True, errors="coerce", cache=False)
+    df = pd.DataFrame({
+        "ts": ts,
+        "group_id": top["group_id"].fillna("").astype("category"),
+        "mood": pay["mood"].astype("category"),
+        "sleep_hours": pd.to_numeric(pay["sleep_hours"], errors="coerce"),
+        "sleep_quality": pay["sleep_quality"].astype("category"),
+        "body": pay["body"],
+        "date": ts.dt.date,
+        "has_body": body_flag(pay["body"]),
+        "is_low": pay["mood"].eq("😟").astype(int),
+    })
     return df
 
 
+def make_rollup_df(rows: List[dict]) -> pd.DataFrame:
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame(rows, columns=["group_id", "day", "n", "low", "has_body", "sleep_sum"])
+    df[["n", "low", "has_body", "sleep_sum"]] = df[["n", "low", "has_body", "sleep_sum"]].fillna(0)
+    df["date"] = pd.to_datetime(df["day"]).dt.date
+    # 現状は group_id を「クラスID」とみなす（クラス数しか種類が無いのでカテゴリ型）
+    df["class_id"] = df["group_id"].fillna("未設定").astype("category")
+    df["group_id"] = df["group_id"].astype("category")
+    return df
+
+
+PRIORITY_MEMO_MAX = 50_000
+
+
+@st.cache_resource(show_spinner=False)
+def priority_memo() -> Dict[Tuple[str, int], str]:
+    """(doc ID, 判定の版) → 優先度。保存済みの msg_priority が無い / 古い相談だけがここに入る。"""
+    return {}
+
+
+def consult_priorities(ids: List[str]) -> List[str]:
+    """保存済みの msg_priority が無い・古い相談の優先度。1 度判定したものはプロセス内にメモしておき
+    （再描画のたびに判定し直さない）、まだのものだけ本文を読んでまとめて判定する。"""
+    memo = priority_memo()
+    out: List[Optional[str]] = [memo.get((i, RISK_CLASSIFIER_VERSION)) for i in ids]
+    todo = [k for k, p in enumerate(out) if p is None]
+    if todo:
+        # 本文は行キャッシュに持っていないので、判定が要る行だけ読む
+        bodies = fetch_bodies([ids[k] for k in todo])
+        scored = message_priority_batch(pd.Series([bodies.get(ids[k], "") for k in todo]))
+        if len(memo) + len(todo) > PRIORITY_MEMO_MAX:
+            memo.clear()
+        for k, p in zip(todo, scored):
+            out[k] = p
+            if ids[k] in bodies:  # 本文を読めなかった行は覚えない（次の読み込みで判定し直す）
+                memo[(ids[k], RISK_CLASSIFIER_VERSION)] = p
+    return out
+
+
 def make_consult_df(rows: List[dict]) -> pd.DataFrame:
     if not rows:
         return pd.DataFrame()
-    df = pd.DataFrame(
-        [
-            {
-                "ts": r.get("ts"),
-                "group_id": r.get("group_id", ""),
-                "message": r.get("message", ""),
-                "topics": ",".join(r.get("topics", []) or []),
-                "intent": r.get("intent", ""),
-                "anonymous": r.get("anonymous", True),
-                "priority": classify_priority_by_message(r.get("message", "")),
-            }
-            for r in rows
-            if isinstance(r.get("ts"), datetime)
-        ]
+    raw = pd.DataFrame(
+        rows, columns=["id", "ts", "group_id", "topics", "intent", "anonymous", "msg_priority", "risk_version"]
     )
-    df["ts"] = pd.to_datetime(df["ts"], utc=True, errors="coerce")
-    df["date"] = df["ts"].dt.date
-    return df
+    # ts が無い・日時として読めない行は除く
+    ts = pd.to_datetime(raw["ts"], utc=True, errors="coerce", cache=False)
+    if ts.isna().any():
+        raw, ts = raw[ts.notna()].reset_index(drop=True), ts[ts.notna()].reset_index(drop=True)
+    # 生徒アプリが保存した msg_priority（本文だけの message_priority）が今の版ならそのまま使い、
+    # それ以外だけ同じ message_priority で判定する（risk_level は気分・睡眠も見るので並び順には使わない）
+    stored = raw["risk_version"].eq(RISK_CLASSIFIER_VERSION) & raw["msg_priority"].fillna("").ne("")
+    priority = raw["msg_priority"].astype(object).where(stored)
+    rest = ~stored
+    if rest.any():
+        priority[rest] = consult_priorities(raw.loc[rest, "id"].tolist())
+    df = pd.DataFrame({
+        "id": raw["id"].astype(STR_DTYPE),
+        "ts": ts,
+        "group_id": raw["group_id"].fillna("").astype("category"),
+        "topics": raw["topics"].astype(object).str.join(",").fillna("").astype("category"),
+        "intent": raw["intent"].fillna("").astype("category"),
+        "anonymous": raw["anonymous"].fillna(True).astype(bool),
+        "date": ts.dt.date,
+        "priority": pd.Categorical(priority, categories=["urgent", "medium", "low"]),
+    })
+    return df.sort_values("ts", kind="stable", ignore_index=True)
+
+
+# 行キャッシュから共有の DataFrame を作る関数（コレクションごと）
+FRAME_BUILDERS: Dict[str, Callable[[List[dict]], pd.DataFrame]] = {
+    "consult_msgs": make_consult_df,
+}
 
 
 def page_dashboard(group_filter: Optional[str]):
@@ -266,18 +673,16 @@ def page_dashboard(group_filter: Optional[str]):
         st.error("Firestore に接続できません。`Secrets` の設定を確認してください。")
         return
 
-    rows_share = fetch_rows_cached("school_share", group_filter, days=60)
-    rows_cons = fetch_rows_cached("consult_msgs", group_filter, days=60)
-
-    df_share = make_share_df(rows_share)
-    df_cons = make_consult_df(rows_cons)
+    df_roll = fetch_rollup_df(group_filter, days=60)
+    df_cons = fetch_consult_df(group_filter, days=60)
+    data_as_of_caption(rollup_window(group_filter), row_cache("consult_msgs", group_filter, CONSULT_FIELDS))
 
     # ---------- KPI カード ----------
     col1, col2, col3 = st.columns(3)
     with col1:
         st.markdown('<div class="kpi-card">', unsafe_allow_html=True)
-        n_days = df_share["date"].nunique() if not df_share.empty else 0
-        n_rec = len(df_share)
+        n_days = df_roll["date"].nunique() if not df_roll.empty else 0
+        n_rec = int(df_roll["n"].sum()) if not df_roll.empty else 0
         st.markdown('<div class="kpi-label">Mood check-ins (60 days)</div>', unsafe_allow_html=True)
         st.markdown(f'<div class="kpi-value">{n_rec}</div>', unsafe_allow_html=True)
         st.markdown(f'<div class="kpi-sub">{n_days} days covered</div>', unsafe_allow_html=True)
@@ -285,8 +690,8 @@ def page_dashboard(group_filter: Optional[str]):
 
     with col2:
         st.markdown('<div class="kpi-card">', unsafe_allow_html=True)
-        if not df_share.empty:
-            low_rate = (df_share["is_low"].sum() / len(df_share) * 100.0)
+        if n_rec:
+            low_rate = (df_roll["low"].sum() / n_rec * 100.0)
             low_rate_txt = f"{low_rate:.1f}%"
         else:
             low_rate_txt = "—"
@@ -307,10 +712,10 @@ def page_dashboard(group_filter: Optional[str]):
     st.markdown("")
 
     # ---------- 時系列グラフ ----------
-    if not df_share.empty:
+    if not df_roll.empty:
         daily = (
-            df_share.groupby("date")
-            .agg(records=("mood", "count"), low=("is_low", "sum"))
+            df_roll.groupby("date")
+            .agg(records=("n", "sum"), low=("low", "sum"))
             .reset_index()
         )
         daily["low_rate"] = (daily["low"] / daily["records"] * 100.0).round(1)
@@ -341,27 +746,24 @@ def page_heatmap(group_filter: Optional[str]):
     # 直近何日を見るか（デフォルト30日）
     days = st.slider("表示する期間（日数）", 7, 60, 30, step=7, key="hm_days")
 
-    rows_share = fetch_rows_cached("school_share", group_filter, days=days)
-    df_share = make_share_df(rows_share)
-    if df_share.empty:
+    df = fetch_rollup_df(group_filter, days=days)
+    data_as_of_caption(rollup_window(group_filter))
+    if df.empty:
         st.caption("指定期間内のデータがありません。")
         return
 
-    df = df_share.copy()
-    # 現状は group_id を「クラスID」とみなす
-    df["class_id"] = df["group_id"].fillna("未設定")
-
-    # 日付×クラス単位で集計
+    # 日付×クラス単位（ロールアップは 1 日 1 クラス 1 件）
     agg = (
-        df.groupby(["class_id", "date"])
+        df.groupby(["class_id", "date"], observed=True)
         .agg(
-            n=("mood", "count"),
-            low=("is_low", "sum"),
+            n=("n", "sum"),
+            low=("low", "sum"),
             body_any=("has_body", "sum"),
-            sleep_avg=("sleep_hours", "mean"),
+            sleep_sum=("sleep_sum", "sum"),
         )
         .reset_index()
     )
+    agg["sleep_avg"] = agg["sleep_sum"] / agg["n"]
     agg["low_rate"] = (agg["low"] / agg["n"] * 100.0).round(1)
     agg["body_rate"] = (agg["body_any"] / agg["n"] * 100.0).round(1)
 
@@ -392,7 +794,7 @@ def page_heatmap(group_filter: Optional[str]):
     st.caption("クラス別サマリー（直近期間）")
 
     summary = (
-        agg.groupby("class_id")
+        agg.groupby("class_id", observed=True)
         .agg(
             days=("date", "nunique"),
             records=("n", "sum"),
@@ -452,6 +854,65 @@ def page_heatmap(group_filter: Optional[str]):
 
 
 # ================== 相談・チケット ==================
+TICKETS_META = "admin_meta/tickets"
+
+
+@st.cache_resource(show_spinner=False)
+def migrate_legacy_tickets() -> int:
+    """rid を doc ID にする前のチケット（ランダムな doc ID・rid フィールドに入れていた）を tickets/{rid} に移す。
+    1 度済めば admin_meta/tickets に印を付け、以降はプロセスごとに印を 1 回読むだけ。移した件数を返す。"""
+    meta = DB.get(TICKETS_META)
+    if meta and meta.get("legacy_migrated"):
+        return 0
+    legacy: List[Doc] = []
+    last = None
+    while True:
+        docs = DB.query("tickets", limit=FETCH_PAGE_SIZE, start_after=last)
+        legacy.extend(d for d in docs if d.data.get("rid") and d.id != d.data["rid"])
+        if len(docs) < FETCH_PAGE_SIZE:
+            break
+        last = docs[-1]
+    # 1 件 = コピーと削除の 2 Write。同じ rid がすでにあれば（重複して起票されていたもの）削除だけ
+    for i in range(0, len(legacy), 250):
+        chunk = legacy[i : i + 250]
+        found = DB.get_many(list({f"tickets/{d.data['rid']}" for d in chunk}))
+        writes = []
+        for d in chunk:
+            path = f"tickets/{d.data['rid']}"
+            if found[path] is None:
+                writes.append(Write("set", path, d.data))
+                found[path] = d.data
+            writes.append(Write("delete", f"tickets/{d.id}", {}))
+        DB.commit(writes)
+    DB.set(TICKETS_META, {"legacy_migrated": True, "migrated_at": now_utc(), "moved": len(legacy)}, merge=True)
+    return len(legacy)
+
+
+def create_tickets(tickets: Dict[str, dict]) -> int:
+    """rid を doc ID にしてまだ無いチケットだけを 1 回のバッチで create する。作成件数を返す。
+
+    存在確認はクエリではなく doc ID の一括取得（get_many）1 回で済ませる（以前の形式のチケットは
+    migrate_legacy_tickets で rid の doc ID に移してある）。
+    確認とコミットの間に別の先生が同じ相談を起票した場合は create が競合してバッチ全体が失敗するので、
+    もう一度だけ確認からやり直す。
+    """
+    migrate_legacy_tickets()
+    if not tickets:
+        return 0
+    for attempt in range(2):
+        found = DB.get_many([f"tickets/{rid}" for rid in tickets])
+        missing = [rid for rid in tickets if found[f"tickets/{rid}"] is None]
+        if not missing:
+            return 0
+        try:
+            DB.commit([Write("create", f"tickets/{rid}", tickets[rid]) for rid in missing])
+            return len(missing)
+        except AlreadyExists:
+            if attempt == 1:
+                raise
+    return 0
+
+
 def page_consult(group_filter: Optional[str]):
     st.markdown("### 🕊 相談・チケット")
 
@@ -459,13 +920,20 @@ def page_consult(group_filter: Optional[str]):
         st.error("Firestore に接続できません。")
         return
 
-    rows_cons = fetch_rows_cached("consult_msgs", group_filter, days=60)
-    df = make_consult_df(rows_cons)
+    df = fetch_consult_df(group_filter, days=60)
+    data_as_of_caption(row_cache("consult_msgs", group_filter, CONSULT_FIELDS))
     if df.empty:
         st.caption("相談データがありません。")
         return
 
-    df_view = df.sort_values("ts", ascending=False)[
+    # 本文は表示する最新 CONSULT_SHOW_ROWS 件の分だけ読む
+    shown = df.iloc[::-1].head(CONSULT_SHOW_ROWS)
+    bodies = fetch_bodies(shown["id"].tolist())
+    shown["message"] = shown["id"].map(bodies).fillna("")
+    if len(df) > len(shown):
+        st.caption(f"新しい {len(shown)} 件を表示しています（全 {len(df)} 件）")
+
+    df_view = shown[
         ["ts", "priority", "intent", "topics", "anonymous", "message"]
     ]
     df_view.rename(
@@ -483,7 +951,7 @@ def page_consult(group_filter: Optional[str]):
 
     st.markdown("---")
     st.caption("⚡ 優先度ごとの件数")
-    cnt = df.groupby("priority").size().reset_index(name="件数")
+    cnt = df.groupby("priority", observed=True).size().reset_index(name="件数")
     cnt["priority"] = cnt["priority"].map(
         {"urgent": "urgent（緊急）", "medium": "medium（中）", "low": "low（低）"}
     )
@@ -493,45 +961,38 @@ def page_consult(group_filter: Optional[str]):
     st.caption("（MVP）相談 → チケット化")
 
     if st.button("最新 50 件をチケットとして起票（重複防止）", type="primary"):
-        okn = 0
-        head50 = df.sort_values("ts", ascending=False).head(50)
+        head50 = shown.head(50)
+        tickets = {}
         for _, row in head50.iterrows():
             rid = hmac_sha256_hex(
                 APP_SECRET, f"{row['ts'].isoformat()}_{row['group_id']}_{row['message'][:40]}"
             )
-            q = DB.collection("tickets").where("rid", "==", rid).limit(1).stream()
-            exists = any(True for _ in q)
-            if exists:
-                continue
-            DB.collection("tickets").add(
-                {
-                    "rid": rid,
-                    "created_at": now_utc(),
-                    "group_id": row["group_id"],
-                    "priority": row["priority"],
-                    "status": "open",
-                    "intent": row["intent"],
-                    "topics": row["topics"].split(",") if row["topics"] else [],
-                    "note_head": (
-                        row["message"][:120] + "..."
-                        if isinstance(row["message"], str) and len(row["message"]) > 120
-                        else row["message"]
-                    ),
-                }
-            )
-            okn += 1
+            tickets[rid] = {
+                "rid": rid,
+                "created_at": now_utc(),
+                "group_id": row["group_id"],
+                "priority": row["priority"],
+                "status": "open",
+                "intent": row["intent"],
+                "topics": row["topics"].split(",") if row["topics"] else [],
+                "note_head": (
+                    row["message"][:120] + "..."
+                    if isinstance(row["message"], str) and len(row["message"]) > 120
+                    else row["message"]
+                ),
+            }
+        try:
+            okn = create_tickets(tickets)
+        except Exception:
+            st.error("起票に失敗しました。もう一度お試しください。")
+            st.stop()
         st.success(f"チケット起票：{okn}件")
 
     st.markdown("---")
     st.markdown("#### チケット一覧（直近100件）")
     try:
-        docs = (
-            DB.collection("tickets")
-            .order_by("created_at", direction="DESCENDING")
-            .limit(100)
-            .stream()
-        )
-        rows = [d.to_dict() | {"id": d.id} for d in docs]
+        docs = DB.query("tickets", order_by="created_at", descending=True, limit=100)
+        rows = [d.data | {"id": d.id} for d in docs]
     except Exception:
         rows = []
 
@@ -565,9 +1026,7 @@ def page_consult(group_filter: Optional[str]):
             if sel != "— 選択しない —":
                 if st.button("✅ 対応完了として記録", key="ticket_close_btn"):
                     try:
-                        DB.collection("tickets").document(sel).set(
-                            {"status": "closed", "closed_at": now_utc()}, merge=True
-                        )
+                        DB.set(f"tickets/{sel}", {"status": "closed", "closed_at": now_utc()}, merge=True)
                         st.success("クローズしました。ページを再読み込みしてください。")
                     except Exception:
                         st.error("更新に失敗しました。")
@@ -578,7 +1037,7 @@ def page_consult(group_filter: Optional[str]):
 
 
 # ================== 設定 ==================
-def page_settings():
+def page_settings(group_filter: Optional[str]):
     st.markdown("### ⚙️ 設定（MVP：画面内のみ）")
     st.caption(
         "将来的には学校ごとに保存しますが、今はこの画面を開いている間だけ有効な簡易設定です。"
@@ -606,6 +1065,17 @@ def page_settings():
     )
     st.caption("※ まだこの値を元にした自動アラートは実装していません。")
 
+    st.markdown("---")
+    st.markdown("#### 日次集計（Dashboard / Heatmap 用）")
+    st.caption(
+        "集計の仕組みを入れる前の記録は Dashboard に出ません。必要なときだけ、過去60日の生データから作り直せます"
+        "（今日の分は記録のたびに加算しているので作り直しません）。"
+    )
+    if st.button("過去60日の日次集計を作り直す", disabled=not FIRESTORE_ENABLED):
+        with st.spinner("集計中…"):
+            n = rebuild_rollups(group_filter, days=60)
+        st.success(f"日次集計：{n}件を書き直しました")
+
 
 # ================== メイン ==================
 def main():
@@ -655,7 +1125,7 @@ def main():
     elif page == "相談・チケット":
         page_consult(group_filter)
     else:
-        page_settings()
+        page_settings(group_filter)
 
 
 if __name__ == "__main__":
@@ -11,9 +11,16 @@ from __future__ import annotations
 from datetime import datetime, timezone, timedelta, date
 from typing import Dict, Tuple, List, Optional, Any
 import streamlit as st
-import pandas as pd
-import altair as alt
-import hashlib, hmac, unicodedata, re, json, os, time
+import streamlit.components.v1 as components
+# pandas / altair は重いので、使う画面（Study・ふりかえり）の中でだけ import する
+import base64, hashlib, hmac, unicodedata, re, json, os, time
+
+from risk import find_risk_hits, message_priority, URGENT, MEDIUM, RISK_CLASSIFIER_VERSION
+from storage import SERVER_TIMESTAMP, AlreadyExists, FirestoreStorage, Increment, Write, local_storage_from_env, new_id
+from writer import BatchWriter
+from spool import Spool
+from handles import TakenHandles
+from locallog import LocalLog, epoch_now
 
 # ================== ページ設定 ==================
 st.set_page_config(
@@ -24,21 +31,24 @@ st.set_page_config(
 )
 
 # ================== Firestore 接続 ==================
+# DB は storage.Storage（環境変数 WITHYOU_STORAGE でメモリ / SQLite にも差し替えられる）
 FIRESTORE_ENABLED = True
 try:
-    from google.cloud import firestore
-    import google.oauth2.service_account as service_account
-
-    @st.cache_resource(show_spinner=False)
-    def firestore_client():
-        creds = service_account.Credentials.from_service_account_info(
-            st.secrets["FIREBASE_SERVICE_ACCOUNT"]
-        )
-        return firestore.Client(
-            project=st.secrets["FIREBASE_SERVICE_ACCOUNT"]["project_id"], 
-            credentials=creds
-        )
-    DB = firestore_client()
+    DB = local_storage_from_env()
+    if DB is None:
+        from google.cloud import firestore
+        import google.oauth2.service_account as service_account
+
+        @st.cache_resource(show_spinner=False)
+        def firestore_storage() -> FirestoreStorage:
+            creds = service_account.Credentials.from_service_account_info(
+                st.secrets["FIREBASE_SERVICE_ACCOUNT"]
+            )
+            return FirestoreStorage(firestore.Client(
+                project=st.secrets["FIREBASE_SERVICE_ACCOUNT"]["project_id"], 
+                credentials=creds
+            ))
+        DB = firestore_storage()
 except Exception:
     FIRESTORE_ENABLED = False
     DB = None
@@ -54,9 +64,6 @@ ADMIN_MASTER_CODE = (
 APP_SECRET = st.secrets.get("APP_SECRET") or os.environ.get("APP_SECRET") or "dev-app-secret-change-me"
 
 # ================== ユーティリティ ==================
-def now_iso() -> str:
-    return datetime.now(timezone.utc).astimezone().isoformat(timespec="seconds")
-
 def hmac_sha256_hex(secret: str, data: str) -> str:
     return hmac.new(secret.encode("utf-8"), data.encode("utf-8"), hashlib.sha256).hexdigest()
 
@@ -110,47 +117,226 @@ def extract_class_info(group_password: str) -> Dict[str, str]:
     }
 
 # ================== データベース操作 ==================
+def user_path(group_id: str, handle_norm: str) -> str:
+    return f"groups/{group_id}/users/{handle_norm}"
+
 def db_create_user(group_id: str, handle_norm: str, class_info: Dict[str, str]) -> Tuple[bool, str]:
     """先着専有：存在すれば失敗。クラス情報も保存"""
     if not FIRESTORE_ENABLED or DB is None:
         return False, "Firestore未接続です"
     
-    ref = DB.collection("groups").document(group_id).collection("users").document(handle_norm)
     try:
-        ref.create({
+        DB.create(user_path(group_id, handle_norm), {
             "user_key": user_key(group_id, handle_norm),
             "created_at": datetime.now(timezone.utc),
             "last_login_at": datetime.now(timezone.utc),
             "class_info": class_info,
         })
-        return True, ""
-    except Exception:
+    except AlreadyExists:
+        taken_handles(group_id).add(handle_norm)  # 競合した：この名前は使用済み
         return False, "この名前はすでに使われています"
+    except Exception:
+        # つながらないなど：この名前が使われたとは限らないので、使用済みには入れない
+        return False, "登録できませんでした。時間をおいてもう一度お試しください"
+    taken_handles(group_id).add(handle_norm)
+    return True, ""
 
-def db_user_exists(group_id: str, handle_norm: str) -> bool:
-    if not FIRESTORE_ENABLED or DB is None:
-        return False
-    ref = DB.collection("groups").document(group_id).collection("users").document(handle_norm)
-    doc = ref.get()
-    return doc.exists
+@st.cache_resource(show_spinner=False, max_entries=256)
+def taken_handles(group_id: str) -> TakenHandles:
+    return TakenHandles(DB, group_id)
 
-def db_touch_login(group_id: str, handle_norm: str):
+def handle_taken_hint(group_id: str, handle_norm: str) -> str:
+    """入力中のニックネームがたぶん使われていれば注意を返す（Firestore は 30 秒に 1 回の差分読みだけ）"""
     if not FIRESTORE_ENABLED or DB is None:
-        return
-    ref = DB.collection("groups").document(group_id).collection("users").document(handle_norm)
+        return ""
     try:
-        ref.set({"last_login_at": datetime.now(timezone.utc)}, merge=True)
+        if taken_handles(group_id).probably_taken(handle_norm):
+            return "この名前はすでに使われているかもしれません。別の名前にすると確実です"
     except Exception:
         pass
+    return ""
+
+# last_login_at を書き直す間隔。"day"（日本時間で日付が変わったら）か秒数
+def parse_login_touch_every(raw: str) -> Optional[float]:
+    """"day" なら None、それ以外は正の秒数。どちらでもなければ起動時に ValueError"""
+    raw = raw.strip().lower()
+    if raw == "day":
+        return None
+    try:
+        sec = float(raw)
+    except ValueError:
+        raise ValueError(f'LOGIN_TOUCH_EVERY は "day" か秒数で指定してください: {raw!r}') from None
+    if not sec > 0:
+        raise ValueError(f"LOGIN_TOUCH_EVERY は 0 より大きい秒数で指定してください: {raw!r}")
+    return sec
+
+LOGIN_TOUCH_EVERY = parse_login_touch_every(
+    str(st.secrets.get("LOGIN_TOUCH_EVERY") or os.environ.get("LOGIN_TOUCH_EVERY") or "day")
+)
 
-def safe_db_add(coll: str, payload: dict) -> bool:
+def login_touch_due(last: Optional[datetime], now: datetime) -> bool:
+    if not isinstance(last, datetime):
+        return True
+    if last.tzinfo is None:
+        last = last.replace(tzinfo=timezone.utc)
+    if LOGIN_TOUCH_EVERY is None:
+        return local_day(last) != local_day(now)
+    return (now - last).total_seconds() >= LOGIN_TOUCH_EVERY
+
+def db_login(group_id: str, handle_norm: str) -> Optional[dict]:
+    """ユーザー doc を読み、last_login_at が古いときだけ更新する（読んだ時点の update_time を前提条件にした
+    書き込みで、その間に doc が変わっていたら読み直す。トランザクションは使わない）。
+    登録が無ければ None（読み取り 1 回、書き込みは間隔ごとに 1 回まで）"""
     if not FIRESTORE_ENABLED or DB is None:
-        return False
+        return None
+    now = datetime.now(timezone.utc)
+
+    def touch(data: Optional[dict]) -> Optional[dict]:
+        if data is not None and login_touch_due(data.get("last_login_at"), now):
+            return {"last_login_at": now}
+        return None
+
+    return DB.update_if(user_path(group_id, handle_norm), touch)
+
+# 送信はまずディスクのスプールに書き（spool.py）、全セッション共通の BatchWriter に載せて
+# 同時に来た送信とまとめてコミットする（writer.py）。Firestore がつながらない間はスプールに残り、
+# 戻ったら古い順に自動で再送される（プロセスを再起動しても残る）。
+# 「送る」はスプールへの追記（ローカルのみ）が済んだ時点で返り、コミットの結果は
+# セッションの _sends に Ticket として持っておいて、次の再実行で status_bar に出す。
+# スプールに書けなかったときは、以前どおりコミットを待ってから返す（届いていないのに入力欄を消さない）。
+SPOOL_DIR = os.environ.get("WITHYOU_SPOOL_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".spool")
+SEND_WAIT_SEC = 20  # スプールを使えないときにコミットを待つ上限
+
+@st.cache_resource(show_spinner=False)
+def batch_writer() -> BatchWriter:
+    return BatchWriter(DB)
+
+@st.cache_resource(show_spinner=False)
+def submit_spool() -> Optional[Spool]:
+    """スプールが使えない（書き込めない・別プロセスが使用中）ときは None で、BatchWriter に直接送る"""
     try:
-        DB.collection(coll).add(payload)
-        return True
-    except Exception:
+        return Spool(SPOOL_DIR, batch_writer())
+    except OSError:
+        return None
+
+if FIRESTORE_ENABLED and DB is not None:
+    submit_spool()  # 前回のプロセスが送れなかった分の再送をすぐ始める
+
+def submit_writes(writes: List[Write], label: str) -> bool:
+    """writes（先頭は本体 doc の create）を 1 件として送る。
+    スプールに書けたらコミットを待たずに True、書けなければコミットを待って結果を返す。"""
+    if not FIRESTORE_ENABLED or DB is None:
         return False
+    # 端末の ts はスプールで遅れて届くことがあるので、管理画面の差分取得用にコミット時刻も入れる
+    head = writes[0]
+    writes = [head._replace(data={**head.data, "committed_at": SERVER_TIMESTAMP}), *writes[1:]]
+    ticket = None
+    spool = submit_spool()
+    if spool is not None:
+        try:
+            ticket = spool.submit(writes)
+        except OSError:
+            ticket = None
+    if ticket is not None:
+        st.session_state.setdefault("_sends", []).append({"label": label, "ticket": ticket})
+        return True
+    ticket = batch_writer().submit(writes)
+    ok = ticket.wait(SEND_WAIT_SEC)
+    if ok is None:
+        # まだ決まっていない：あとで届くこともあるので結果は status_bar に出す
+        st.session_state.setdefault("_sends", []).append({"label": label, "ticket": ticket})
+    return bool(ok)
+
+def safe_db_add(coll: str, payload: dict, label: str) -> bool:
+    return submit_writes([Write("create", f"{coll}/{new_id()}", payload)], label)
+
+# ================== 日次ロールアップ（管理画面用の集計） ==================
+ROLLUP_COLL = "share_daily"
+LOCAL_TZ = timezone(timedelta(hours=9))  # 学校の「1日」は日本時間で区切る
+
+def local_day(ts: datetime) -> str:
+    return ts.astimezone(LOCAL_TZ).strftime("%Y-%m-%d")
+
+def share_rollup_update(payload: dict) -> Tuple[str, Dict[str, Any]]:
+    """school_share 1件ぶんの (group_id, 日) ロールアップの doc ID と Increment 更新を作る"""
+    p = payload["payload"]
+    gid = payload.get("group_id", "")
+    day = local_day(payload["ts"])
+    return f"{gid}_{day}", {
+        "group_id": gid,
+        "day": day,
+        "n": Increment(1),
+        "low": Increment(int(p.get("mood") == "😟")),
+        "has_body": Increment(int(any(b != "なし" for b in (p.get("body") or [])))),
+        "sleep_sum": Increment(float(p.get("sleep_hours") or 0.0)),
+    }
+
+# ================== 生徒ごとのまとめ（users doc） ==================
+# groups/{gid}/users/{handle} に記録した日（checkin_days: {日付: True}）・記録回数・学習時間の合計を持ち、
+# school_share と同じバッチで更新する。書き込みは日付キーの merge と Increment だけなので、
+# スプールで遅れて届いても・複数の端末から送っても互いを上書きしない。連続日数は読んだ側が日付から数える。
+# HOME の連続日数はセッションの _checkin（最後に記録した日, 連続日数）を読むだけで、
+# ログイン時の読み取りか再開トークンから入れる（セッション再開では Firestore を読まない）。
+def checkin_state(data: Optional[dict]) -> Tuple[str, int]:
+    """users doc から（最後に記録した日, その日までの連続日数）"""
+    data = data or {}
+    days = {date.fromisoformat(d) for d in (data.get("checkin_days") or {})}
+    # checkin_days を入れる前の doc は、最後の日と連続日数を値で持っている
+    last, run = data.get("last_checkin_day"), data.get("checkin_streak") or 0
+    if last:
+        days |= {date.fromisoformat(last) - timedelta(days=i) for i in range(run)}
+    if not days:
+        return "", 0
+    last = max(days)
+    run = 1
+    while last - timedelta(days=run) in days:
+        run += 1
+    return last.isoformat(), run
+
+def advance_checkin(state: Tuple[str, int], day: str) -> Tuple[str, int]:
+    """day（日本時間の日付）に 1 回記録したあとの（最後に記録した日, 連続日数）。表示用"""
+    last, run = state
+    if day <= last:
+        return state
+    if last and (date.fromisoformat(day) - date.fromisoformat(last)).days == 1:
+        return day, run + 1
+    return day, 1
+
+def checkin_update(day: str, study_minutes: int) -> Dict[str, Any]:
+    """day に 1 回記録したときの users doc への merge（読まずに書ける・何度届いても日付は 1 つ）"""
+    return {
+        "checkin_days": {day: True},
+        "total_checkins": Increment(1),
+        "total_study_minutes": Increment(study_minutes),
+    }
+
+def checkin_streak(state: Optional[Tuple[str, int]]) -> int:
+    """今日（日本時間）記録していれば連続日数、まだなら 0（ノートの連続日数と同じ数え方）"""
+    if not state:
+        return 0
+    last, run = state
+    return run if last == local_day(datetime.now(timezone.utc)) else 0
+
+def safe_db_add_share(payload: dict) -> bool:
+    """school_share の追加・日次ロールアップの加算・本人のまとめの更新を同じバッチでコミット"""
+    rid, update = share_rollup_update(payload)
+    writes = [
+        Write("create", f"school_share/{new_id()}", payload),
+        Write("merge", f"{ROLLUP_COLL}/{rid}", update),
+    ]
+    gid, hdl = payload.get("group_id"), payload.get("handle")
+    day = local_day(payload["ts"])
+    if gid and hdl:
+        # この端末で記録した学習時間のうち、まだ送っていない分を一緒に足す
+        study_total = st.session_state["_local_logs"].study_stats.total
+        study_new = study_total - st.session_state.get("_study_sent", 0)
+        writes.append(Write("merge", user_path(gid, hdl), checkin_update(day, study_new)))
+    ok = submit_writes(writes, "きょうの記録")
+    if ok and gid and hdl:
+        st.session_state["_study_sent"] = study_total
+        st.session_state["_checkin"] = advance_checkin(st.session_state.get("_checkin") or ("", 0), day)
+        save_resume_token()
+    return ok
 
 # ================== 気分の絵文字マッピング ==================
 MOOD_EMOJI_MAP = {
@@ -166,28 +352,12 @@ def get_mood_label(emoji: str) -> str:
 # ================== リスク判定ロジック ==================
 def classify_risk_level(message: str, mood: str, body: List[str], sleep_hours: float) -> str:
     """総合的なリスクレベルを判定"""
-    if not message:
-        message = ""
-    
-    text = message.lower()
+    hits = find_risk_hits(message)
     
-    urgent_keywords = [
-        "死にたい", "自殺", "消えたい", "死ぬ", "終わり",
-        "暴力", "虐待", "いじめられ", "殴られ", "蹴られ",
-        "希死", "自傷", "リストカット", "OD", "飛び降り"
-    ]
-    
-    for kw in urgent_keywords:
-        if kw in text:
-            return "urgent"
-    
-    medium_keywords = [
-        "眠れない", "食べられない", "吐き気", "しんどい",
-        "助けて", "不安", "落ち込", "つらい", "苦しい",
-        "パニック", "過呼吸", "動悸"
-    ]
+    if any(sev == URGENT for _, sev in hits):
+        return "urgent"
     
-    medium_count = sum(1 for kw in medium_keywords if kw in text)
+    medium_count = len({kw for kw, sev in hits if sev == MEDIUM})
     
     if mood == "😟" and body and any(b != "なし" for b in body):
         return "medium"
@@ -201,27 +371,9 @@ def classify_risk_level(message: str, mood: str, body: List[str], sleep_hours: f
     return "low"
 
 # ================== ゲーミフィケーション機能 ==================
-def calculate_streak(logs: List[Dict]) -> int:
-    """連続記録日数を計算"""
-    if not logs:
-        return 0
-    
-    try:
-        dates = sorted(set(datetime.fromisoformat(log['ts']).date() for log in logs), reverse=True)
-    except:
-        return 0
-    
-    if not dates or dates[0] != date.today():
-        return 0
-    
-    streak = 1
-    for i in range(len(dates)-1):
-        if (dates[i] - dates[i+1]).days == 1:
-            streak += 1
-        else:
-            break
-    
-    return streak
+def calculate_streak(logs: LocalLog) -> int:
+    """連続記録日数（日付は日本時間。LocalLog がノートのたびに進めている状態を読むだけ）"""
+    return logs.streak.current(datetime.now(LOCAL_TZ).date())
 
 def get_study_level(total_minutes: int) -> Dict[str, Any]:
     """学習レベルを取得"""
@@ -252,8 +404,37 @@ st.session_state.setdefault("role", "user")
 # テーマ設定
 st.session_state.setdefault("theme", "🌙 静かな夜空")
 
-# ローカルログ（端末保存）
-st.session_state.setdefault("_local_logs", {"note":[], "breath":[], "study":[]})
+# ローカルログ（端末保存）：locallog.LocalLog（件数の上限つき・溢れた分は一時ファイル）
+if "_local_logs" not in st.session_state:
+    st.session_state["_local_logs"] = LocalLog(tz=LOCAL_TZ)
+
+def fmt_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).astimezone().isoformat(timespec="seconds")
+
+def note_to_dict(r) -> Dict[str, Any]:
+    m = MOOD_BY_KEY.get(r.mood, {})
+    return {
+        "ts": fmt_ts(r.ts),
+        "mood": {"key": r.mood or None, "label": m.get("label"), "emoji": m.get("emoji"), "intensity": r.intensity},
+        "trigger": r.trigger,
+        "auto": r.auto,
+        "reason_for": r.reason_for,
+        "reason_against": r.reason_against,
+        "alt_perspective": r.alt_perspective,
+        "action": {"suggested": r.action_suggested, "custom": r.action_custom},
+        "diary": r.diary,
+    }
+
+def rec_to_dict(r) -> Dict[str, Any]:
+    """呼吸・Study の記録を保存前と同じ形の dict にする"""
+    return r._asdict() | {"ts": fmt_ts(r.ts)}
+
+def export_logs(logs: LocalLog) -> Dict[str, List[Dict[str, Any]]]:
+    return {
+        "note": [note_to_dict(r) for r in logs.all("note")],
+        "breath": [rec_to_dict(r) for r in logs.all("breath")],
+        "study": [rec_to_dict(r) for r in logs.all("study")],
+    }
 
 # Study Tracker用の目標設定
 st.session_state.setdefault("study_weekly_goal", 300)
@@ -288,18 +469,9 @@ THEMES = {
 }
 
 # ================== スタイル【🌙 エモい夜空版 v4】 ==================
-def inject_css():
-    theme = THEMES[st.session_state.get("theme", "🌙 静かな夜空")]
-    
-    st.markdown(f"""
-<style>
-:root {{
-  --bg-start: {theme['bg_start']};
-  --bg-mid: {theme['bg_mid']};
-  --bg-end: {theme['bg_end']};
-  --accent: {theme['accent']};
-  --accent-soft: {theme['accent_soft']};
-  --success: {theme['success']};
+# テーマに依存しない本体。テーマ色は :root の変数だけで切り替える（theme_css）
+APP_CSS = """
+:root {
   --text-primary: #e8eaf0;
   --text-secondary: #a8b3d7;
   --text-muted: #7a8ab0;
@@ -307,18 +479,18 @@ def inject_css():
   --shadow: 0 4px 20px rgba(0, 0, 0, 0.3);
   --glow: 0 0 20px var(--accent);
   --glow-soft: 0 0 30px rgba(195, 177, 225, 0.15);
-}}
+}
 
-html, body, .stApp {{
+html, body, .stApp {
   background: linear-gradient(165deg, var(--bg-start) 0%, var(--bg-mid) 40%, var(--bg-end) 100%);
   color: var(--text-primary);
   min-height: 100vh;
   font-family: 'Noto Sans JP', -apple-system, BlinkMacSystemFont, sans-serif;
   font-weight: 400;
   line-height: 1.7;
-}}
+}
 
-html::before {{
+html::before {
   content: '';
   position: fixed;
   top: 0; left: 0;
@@ -328,22 +500,22 @@ html::before {{
   pointer-events: none;
   animation: gentleFloat 8s ease-in-out infinite;
   z-index: 0;
-}}
+}
 
-@keyframes gentleFloat {{
-  0%, 100% {{ opacity: 0.06; }}
-  50% {{ opacity: 0.12; }}
-}}
+@keyframes gentleFloat {
+  0%, 100% { opacity: 0.06; }
+  50% { opacity: 0.12; }
+}
 
-.block-container {{
+.block-container {
   max-width: 920px;
   padding-top: 1.5rem;
   padding-bottom: 3rem;
   position: relative;
   z-index: 1;
-}}
+}
 
-.card {{
+.card {
   background: rgba(26, 26, 46, 0.6);
   border: 1px solid var(--border);
   border-radius: 20px;
@@ -351,15 +523,15 @@ html::before {{
   box-shadow: var(--shadow);
   backdrop-filter: blur(20px);
   transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
-}}
+}
 
-.card:hover {{
+.card:hover {
   border-color: var(--accent);
   box-shadow: var(--shadow), var(--glow-soft);
   transform: translateY(-2px);
-}}
+}
 
-.item {{
+.item {
   background: rgba(26, 26, 46, 0.5);
   border: 1px solid var(--border);
   border-radius: 18px;
@@ -368,31 +540,31 @@ html::before {{
   backdrop-filter: blur(16px);
   margin-bottom: 12px;
   transition: all 0.3s ease;
-}}
+}
 
-.item:hover {{
+.item:hover {
   border-color: var(--accent-soft);
   box-shadow: var(--shadow), 0 0 15px rgba(195, 177, 225, 0.1);
-}}
+}
 
-.tip {{
+.tip {
   color: var(--text-muted);
   font-size: 0.88rem;
   line-height: 1.6;
   font-weight: 300;
-}}
+}
 
-h1, h2, h3, h4, h5, h6 {{
+h1, h2, h3, h4, h5, h6 {
   color: var(--text-primary) !important;
   font-weight: 600;
   letter-spacing: 0.01em;
-}}
+}
 
-p, div, span, label {{
+p, div, span, label {
   color: var(--text-primary);
-}}
+}
 
-.top-tabs {{
+.top-tabs {
   position: sticky;
   top: 0;
   z-index: 50;
@@ -403,9 +575,9 @@ p, div, span, label {{
   box-shadow: var(--shadow);
   padding: 8px 10px;
   margin-bottom: 16px;
-}}
+}
 
-.top-tabs .stButton > button {{
+.top-tabs .stButton > button {
   width: 100%;
   height: 38px;
   border-radius: 12px;
@@ -415,25 +587,25 @@ p, div, span, label {{
   border: none;
   color: var(--text-secondary);
   transition: all 0.3s ease;
-}}
+}
 
-.top-tabs .stButton > button:hover {{
+.top-tabs .stButton > button:hover {
   background: rgba(195, 177, 225, 0.1);
   color: var(--accent);
-}}
+}
 
-.top-tabs .active .stButton > button {{
+.top-tabs .active .stButton > button {
   background: linear-gradient(135deg, var(--accent) 0%, var(--accent-soft) 100%);
   color: #ffffff;
   font-weight: 600;
   box-shadow: var(--glow-soft);
-}}
+}
 
-.bigbtn {{
+.bigbtn {
   margin-bottom: 14px;
-}}
+}
 
-.bigbtn .stButton > button {{
+.bigbtn .stButton > button {
   width: 100%;
   text-align: left;
   border-radius: 20px;
@@ -447,27 +619,27 @@ p, div, span, label {{
   font-weight: 500;
   transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
   backdrop-filter: blur(16px);
-}}
+}
 
-.bigbtn .stButton > button:hover {{
+.bigbtn .stButton > button:hover {
   border-color: var(--accent);
   box-shadow: var(--shadow), var(--glow-soft);
   transform: translateY(-3px);
   background: rgba(26, 26, 46, 0.7);
-}}
+}
 
-.bigbtn .stButton > button:active {{
+.bigbtn .stButton > button:active {
   transform: translateY(-1px) scale(0.98);
   transition: transform 0.1s ease;
-}}
+}
 
-.bigbtn .stButton > button::first-line {{
+.bigbtn .stButton > button::first-line {
   font-weight: 700;
   font-size: 1.05rem;
   color: var(--accent-soft);
-}}
+}
 
-.cbt-card {{
+.cbt-card {
   background: rgba(26, 26, 46, 0.5);
   border: 1px solid var(--border);
   border-radius: 18px;
@@ -476,83 +648,30 @@ p, div, span, label {{
   margin-bottom: 14px;
   backdrop-filter: blur(16px);
   transition: all 0.3s ease;
-}}
+}
 
-.cbt-card:hover {{
+.cbt-card:hover {
   border-color: var(--accent-soft);
   box-shadow: var(--shadow), 0 0 15px rgba(195, 177, 225, 0.1);
-}}
+}
 
-.cbt-heading {{
+.cbt-heading {
   font-weight: 600;
   font-size: 0.98rem;
   color: var(--accent-soft);
   margin: 0 0 6px 0;
   letter-spacing: 0.01em;
-}}
+}
 
-.cbt-sub {{
+.cbt-sub {
   color: var(--text-secondary);
   font-size: 0.86rem;
   margin: -2px 0 10px 0;
   line-height: 1.6;
   font-weight: 300;
-}}
-
-.breath-container {{
-  display: flex;
-  justify-content: center;
-  align-items: center;
-  padding: 30px 0;
-  position: relative;
-}}
-
-.breath-spot {{
-  width: 280px;
-  height: 280px;
-  border-radius: 999px;
-  background: radial-gradient(circle at 50% 40%, rgba(255, 255, 255, 0.15) 0%, rgba(195, 177, 225, 0.1) 30%, rgba(168, 211, 234, 0.05) 70%, transparent 100%);
-  border: 2px solid rgba(195, 177, 225, 0.3);
-  box-shadow: 0 0 40px rgba(195, 177, 225, 0.2), inset 0 0 50px rgba(255, 255, 255, 0.05);
-  position: relative;
-  transition: all 1.2s cubic-bezier(0.4, 0, 0.2, 1);
-}}
+}
 
-.breath-spot::before {{
-  content: '';
-  position: absolute;
-  top: 50%; left: 50%;
-  width: 80%; height: 80%;
-  transform: translate(-50%, -50%);
-  border-radius: 999px;
-  background: radial-gradient(circle, rgba(255, 255, 255, 0.1) 0%, transparent 70%);
-  animation: breathFloat 4s ease-in-out infinite;
-}}
-
-@keyframes breathFloat {{
-  0%, 100% {{ transform: translate(-50%, -50%) scale(1); opacity: 0.5; }}
-  50% {{ transform: translate(-50%, -48%) scale(1.02); opacity: 0.8; }}
-}}
-
-.breath-spot.inhale {{
-  transform: scale(1.25);
-  border-color: rgba(168, 230, 207, 0.5);
-  box-shadow: 0 0 60px rgba(168, 230, 207, 0.3), inset 0 0 60px rgba(255, 255, 255, 0.08);
-}}
-
-.breath-spot.hold {{
-  transform: scale(1.25);
-  border-color: rgba(195, 177, 225, 0.5);
-  box-shadow: 0 0 50px rgba(195, 177, 225, 0.3), inset 0 0 55px rgba(255, 255, 255, 0.08);
-}}
-
-.breath-spot.exhale {{
-  transform: scale(0.9);
-  border-color: rgba(168, 211, 234, 0.4);
-  box-shadow: 0 0 35px rgba(168, 211, 234, 0.25), inset 0 0 45px rgba(255, 255, 255, 0.05);
-}}
-
-.study-goal-card {{
+.study-goal-card {
   background: linear-gradient(135deg, rgba(195, 177, 225, 0.08) 0%, rgba(168, 230, 207, 0.08) 100%);
   border: 1px solid var(--border);
   border-radius: 18px;
@@ -560,25 +679,25 @@ p, div, span, label {{
   margin-bottom: 14px;
   box-shadow: var(--shadow);
   backdrop-filter: blur(16px);
-}}
+}
 
-.progress-bar-container {{
+.progress-bar-container {
   background: rgba(120, 130, 160, 0.2);
   border-radius: 12px;
   height: 10px;
   overflow: hidden;
   margin: 8px 0;
-}}
+}
 
-.progress-bar-fill {{
+.progress-bar-fill {
   background: linear-gradient(90deg, var(--accent) 0%, var(--accent-soft) 100%);
   height: 100%;
   border-radius: 12px;
   transition: width 0.8s cubic-bezier(0.4, 0, 0.2, 1);
   box-shadow: 0 0 10px var(--accent);
-}}
+}
 
-.study-stat {{
+.study-stat {
   display: inline-block;
   padding: 6px 14px;
   background: rgba(26, 26, 46, 0.5);
@@ -588,9 +707,9 @@ p, div, span, label {{
   font-size: 0.88rem;
   color: var(--text-secondary);
   font-weight: 500;
-}}
+}
 
-.badge {{
+.badge {
   display: inline-block;
   padding: 8px 16px;
   background: linear-gradient(135deg, var(--accent) 0%, var(--accent-soft) 100%);
@@ -601,69 +720,69 @@ p, div, span, label {{
   font-weight: 600;
   box-shadow: var(--glow-soft);
   animation: badgePop 0.5s cubic-bezier(0.68, -0.55, 0.27, 1.55);
-}}
+}
 
-@keyframes badgePop {{
-  0% {{ transform: scale(0); opacity: 0; }}
-  100% {{ transform: scale(1); opacity: 1; }}
-}}
+@keyframes badgePop {
+  0% { transform: scale(0); opacity: 0; }
+  100% { transform: scale(1); opacity: 1; }
+}
 
-.meta {{
+.meta {
   color: var(--text-muted);
   font-size: 0.8rem;
   margin-bottom: 0.3rem;
   font-weight: 300;
-}}
+}
 
-.small {{
+.small {
   font-size: 0.86rem;
   color: var(--text-secondary);
   font-weight: 300;
-}}
+}
 
 .stTextInput > div > div > input,
 .stTextArea > div > div > textarea,
-.stNumberInput > div > div > input {{
+.stNumberInput > div > div > input {
   background: rgba(26, 26, 46, 0.6) !important;
   border: 1px solid var(--border) !important;
   border-radius: 12px !important;
   color: var(--text-primary) !important;
   padding: 10px 14px !important;
   transition: all 0.3s ease !important;
-}}
+}
 
 .stTextInput > div > div > input:focus,
 .stTextArea > div > div > textarea:focus,
-.stNumberInput > div > div > input:focus {{
+.stNumberInput > div > div > input:focus {
   border-color: var(--accent) !important;
   box-shadow: 0 0 0 2px rgba(195, 177, 225, 0.2) !important;
   background: rgba(26, 26, 46, 0.8) !important;
-}}
+}
 
-.stSelectbox > div > div > select {{
+.stSelectbox > div > div > select {
   background: rgba(26, 26, 46, 0.9) !important;
   border: 1px solid var(--border) !important;
   color: #1a1a1a !important;
   border-radius: 12px !important;
   padding: 10px 14px !important;
   transition: all 0.3s ease !important;
-}}
+}
 
-.stSelectbox > div > div > select:focus {{
+.stSelectbox > div > div > select:focus {
   border-color: var(--accent) !important;
   box-shadow: 0 0 0 2px rgba(195, 177, 225, 0.2) !important;
-}}
+}
 
 /* プレースホルダー（Choose options）の色 */
-.stSelectbox [data-baseweb="select"] input {{
+.stSelectbox [data-baseweb="select"] input {
   color: #2d2d2d !important;
-}}
+}
 
-.stSelectbox [data-baseweb="select"] > div {{
+.stSelectbox [data-baseweb="select"] > div {
   color: #2d2d2d !important;
-}}
+}
 
-.stButton > button {{
+.stButton > button {
   background: rgba(195, 177, 225, 0.15);
   border: 1px solid var(--border);
   color: var(--accent-soft);
@@ -672,113 +791,113 @@ p, div, span, label {{
   padding: 10px 20px;
   transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
   box-shadow: var(--shadow);
-}}
+}
 
-.stButton > button:hover {{
+.stButton > button:hover {
   background: rgba(195, 177, 225, 0.25);
   border-color: var(--accent);
   box-shadow: var(--shadow), var(--glow-soft);
   transform: translateY(-2px);
-}}
+}
 
-.stButton > button:active {{
+.stButton > button:active {
   transform: translateY(0) scale(0.98);
   transition: transform 0.1s ease;
-}}
+}
 
-.stButton > button[kind="primary"] {{
+.stButton > button[kind="primary"] {
   background: linear-gradient(135deg, var(--accent) 0%, var(--accent-soft) 100%);
   border: none;
   color: #ffffff;
   box-shadow: var(--shadow), var(--glow-soft);
   font-weight: 600;
-}}
+}
 
-.stButton > button[kind="primary"]:hover {{
+.stButton > button[kind="primary"]:hover {
   box-shadow: var(--shadow), var(--glow);
   transform: translateY(-2px);
-}}
+}
 
-.stRadio > div {{
+.stRadio > div {
   background: rgba(26, 26, 46, 0.4);
   border: 1px solid var(--border);
   border-radius: 12px;
   padding: 10px;
-}}
+}
 
-.stRadio > div > label {{
+.stRadio > div > label {
   color: var(--text-primary) !important;
   font-weight: 500;
-}}
+}
 
-.stCheckbox > label {{
+.stCheckbox > label {
   color: var(--text-primary) !important;
   font-weight: 500;
-}}
+}
 
-.stSlider > div > div > div {{
+.stSlider > div > div > div {
   background: rgba(195, 177, 225, 0.2) !important;
-}}
+}
 
-.stSlider > div > div > div > div {{
+.stSlider > div > div > div > div {
   background: var(--accent) !important;
   box-shadow: 0 0 8px var(--accent) !important;
-}}
+}
 
 .stSelectbox > label,
 .stMultiSelect > label,
 .stTextInput > label,
 .stTextArea > label,
-.stNumberInput > label {{
+.stNumberInput > label {
   color: var(--text-secondary) !important;
   font-weight: 500;
   font-size: 0.88rem;
-}}
+}
 
-.stMultiSelect > div > div {{
+.stMultiSelect > div > div {
   background: rgba(26, 26, 46, 0.6) !important;
   border: 1px solid var(--border) !important;
   border-radius: 12px !important;
-}}
+}
 
-.stMultiSelect span[data-baseweb="tag"] {{
+.stMultiSelect span[data-baseweb="tag"] {
   background-color: rgba(195, 177, 225, 0.25) !important;
   border: 1px solid var(--accent) !important;
   color: var(--text-primary) !important;
   border-radius: 10px !important;
-}}
+}
 
-.stTabs > div > div > div {{
+.stTabs > div > div > div {
   background: rgba(26, 26, 46, 0.5);
   border: 1px solid var(--border);
   border-radius: 12px;
-}}
+}
 
-.stTabs [data-baseweb="tab"] {{
+.stTabs [data-baseweb="tab"] {
   color: var(--text-secondary);
   font-weight: 500;
-}}
+}
 
-.stTabs [aria-selected="true"] {{
+.stTabs [aria-selected="true"] {
   color: var(--accent);
   border-bottom-color: var(--accent);
-}}
+}
 
-.stSuccess, .stError, .stWarning, .stInfo {{
+.stSuccess, .stError, .stWarning, .stInfo {
   background: rgba(26, 26, 46, 0.8) !important;
   border-radius: 12px !important;
   border-left: 4px solid var(--success) !important;
   backdrop-filter: blur(16px) !important;
   color: var(--text-primary) !important;
-}}
+}
 
-.stError {{
+.stError {
   border-left-color: #f6c6ea !important;
-}}
+}
 
-hr {{
+hr {
   border-color: var(--border) !important;
-}}
+}
 
 /* ==================== セレクトボックス完全上書き ==================== */
 
@@ -789,17 +908,17 @@ hr {{
 .stSelectbox [data-baseweb="select"] > div *,
 .stSelectbox [data-baseweb="select"] input,
 .stSelectbox [data-baseweb="select"] span,
-.stSelectbox [data-baseweb="select"] div {{
+.stSelectbox [data-baseweb="select"] div {
   background-color: #ffffff !important;
   color: #000000 !important;
-}}
+}
 
 /* ドロップダウンメニュー全体 */
 .stSelectbox [role="listbox"],
-.stSelectbox [role="listbox"] * {{
+.stSelectbox [role="listbox"] * {
   background-color: #ffffff !important;
   border: 1px solid var(--accent) !important;
-}}
+}
 
 /* 各選択肢 - すべての子孫要素に適用 */
 .stSelectbox [role="option"],
@@ -810,37 +929,37 @@ hr {{
 .stSelectbox li,
 .stSelectbox li *,
 .stSelectbox li span,
-.stSelectbox li div {{
+.stSelectbox li div {
   background-color: #ffffff !important;
   color: #000000 !important;
   padding: 10px 14px !important;
-}}
+}
 
 /* ホバー時 */
 .stSelectbox [role="option"]:hover,
 .stSelectbox [role="option"]:hover *,
 .stSelectbox [role="option"]:hover span,
 .stSelectbox li:hover,
-.stSelectbox li:hover * {{
+.stSelectbox li:hover * {
   background-color: rgba(195, 177, 225, 0.3) !important;
   color: #000000 !important;
-}}
+}
 
 /* 選択済み */
 .stSelectbox [role="option"][aria-selected="true"],
 .stSelectbox [role="option"][aria-selected="true"] *,
-.stSelectbox [role="option"][aria-selected="true"] span {{
+.stSelectbox [role="option"][aria-selected="true"] span {
   background-color: rgba(195, 177, 225, 0.4) !important;
   color: #000000 !important;
   font-weight: 600 !important;
-}}
+}
 
 /* 無効化 */
 .stSelectbox [role="option"][aria-disabled="true"],
-.stSelectbox [role="option"][aria-disabled="true"] * {{
+.stSelectbox [role="option"][aria-disabled="true"] * {
   color: #666666 !important;
   opacity: 0.6 !important;
-}}
+}
 
 /* Multiselect用にも同じスタイル適用 */
 .stMultiSelect [data-baseweb="select"],
@@ -849,17 +968,17 @@ hr {{
 .stMultiSelect [data-baseweb="select"] > div *,
 .stMultiSelect [data-baseweb="select"] input,
 .stMultiSelect [data-baseweb="select"] span,
-.stMultiSelect [data-baseweb="select"] div {{
+.stMultiSelect [data-baseweb="select"] div {
   background-color: #ffffff !important;
   color: #000000 !important;
-}}
+}
 
 /* Multiselectのドロップダウンリスト */
 .stMultiSelect [role="listbox"],
-.stMultiSelect [role="listbox"] * {{
+.stMultiSelect [role="listbox"] * {
   background-color: #ffffff !important;
   border: 1px solid var(--accent) !important;
-}}
+}
 
 .stMultiSelect [role="option"],
 .stMultiSelect [role="option"] *,
@@ -868,59 +987,55 @@ hr {{
 .stMultiSelect li,
 .stMultiSelect li *,
 .stMultiSelect li span,
-.stMultiSelect li div {{
+.stMultiSelect li div {
   background-color: #ffffff !important;
   color: #000000 !important;
   padding: 10px 14px !important;
-}}
+}
 
 .stMultiSelect [role="option"]:hover,
 .stMultiSelect [role="option"]:hover *,
 .stMultiSelect [role="option"]:hover span,
 .stMultiSelect li:hover,
-.stMultiSelect li:hover * {{
+.stMultiSelect li:hover * {
   background-color: rgba(195, 177, 225, 0.3) !important;
   color: #000000 !important;
-}}
+}
 
-@media (max-width: 768px) {{
-  .block-container {{
+@media (max-width: 768px) {
+  .block-container {
     padding-top: 1rem;
     padding-bottom: 2rem;
-  }}
-  .bigbtn .stButton > button {{
+  }
+  .bigbtn .stButton > button {
     padding: 18px 16px 14px;
     font-size: 0.95rem;
-  }}
-  .breath-spot {{
-    width: 240px;
-    height: 240px;
-  }}
-  .top-tabs .stButton > button {{
+  }
+  .top-tabs .stButton > button {
     font-size: 0.75rem;
     height: 36px;
-  }}
-}}
+  }
+}
 
-::-webkit-scrollbar {{
+::-webkit-scrollbar {
   width: 8px;
   height: 8px;
-}}
+}
 
-::-webkit-scrollbar-track {{
+::-webkit-scrollbar-track {
   background: rgba(26, 26, 46, 0.5);
   border-radius: 4px;
-}}
+}
 
-::-webkit-scrollbar-thumb {{
+::-webkit-scrollbar-thumb {
   background: var(--accent);
   border-radius: 4px;
   box-shadow: 0 0 5px var(--accent);
-}}
+}
 
-::-webkit-scrollbar-thumb:hover {{
+::-webkit-scrollbar-thumb:hover {
   background: var(--accent-soft);
-}}
+}
 
 /* ==================== セレクトボックス緊急修正 v2 ==================== */
 /* Streamlit Multiselect/Selectbox の完全上書き */
@@ -934,41 +1049,37 @@ ul[role="listbox"] *,
 li[role="option"],
 li[role="option"] *,
 .stSelectbox *,
-.stMultiSelect * {{
+.stMultiSelect * {
   color: #000000 !important;
-}}
+}
 
 /* 背景を白に */
 div[data-baseweb="select"],
 div[data-baseweb="popover"],
 ul[role="listbox"],
-li[role="option"] {{
+li[role="option"] {
   background-color: #ffffff !important;
-}}
+}
 
 /* ホバー時 */
 li[role="option"]:hover,
-li[role="option"]:hover * {{
+li[role="option"]:hover * {
   background-color: rgba(195, 177, 225, 0.3) !important;
   color: #000000 !important;
-}}
+}
 
 /* 選択済み */
 li[role="option"][aria-selected="true"],
-li[role="option"][aria-selected="true"] * {{
+li[role="option"][aria-selected="true"] * {
   background-color: rgba(195, 177, 225, 0.4) !important;
   color: #000000 !important;
   font-weight: 600 !important;
-}}
-
-</style>
-""", unsafe_allow_html=True)
+}
 
-inject_css()
+"""
 
 # セレクトボックスの視認性を強制的に改善
-st.markdown("""
-<style>
+SELECT_CSS = """
 /* 最優先ルール - 全ての要素に適用 */
 div[data-baseweb="select"], 
 div[data-baseweb="select"] *, 
@@ -1044,8 +1155,36 @@ li[role="option"]:hover * {
     color: #000000 !important;
     background-color: #ffffff !important;
 }
-</style>
-""", unsafe_allow_html=True)
+"""
+
+def minify_css(css: str) -> str:
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+@st.cache_resource(show_spinner=False)
+def style_tag(css: str) -> str:
+    """最小化した <style> タグ。CSS の内容（のハッシュ）ごとにプロセスで 1 回だけ作る"""
+    return f"<style>{minify_css(css)}</style>"
+
+@st.cache_resource(show_spinner=False)
+def theme_css(theme_name: str) -> str:
+    """テーマ色の :root 変数だけの小さな <style> タグ"""
+    theme = THEMES[theme_name]
+    return (
+        "<style>:root{"
+        f"--bg-start:{theme['bg_start']};--bg-mid:{theme['bg_mid']};--bg-end:{theme['bg_end']};"
+        f"--accent:{theme['accent']};--accent-soft:{theme['accent_soft']};--success:{theme['success']}"
+        "}</style>"
+    )
+
+def inject_css():
+    st.markdown(style_tag(APP_CSS + SELECT_CSS), unsafe_allow_html=True)
+    st.markdown(theme_css(st.session_state.get("theme", "🌙 静かな夜空")), unsafe_allow_html=True)
+
+inject_css()
 
 # ================== ナビゲーション ==================
 def get_sections():
@@ -1079,7 +1218,29 @@ def top_tabs():
     
     st.markdown("</div>", unsafe_allow_html=True)
 
+def send_status():
+    """送った記録・相談のコミット結果（前回の再実行以降に決まったもの）を出す"""
+    sends = st.session_state.get("_sends") or []
+    waiting = []
+    for s in sends:
+        t = s["ticket"]
+        if not t.done:
+            waiting.append(s)
+        elif not t.ok:
+            st.error(f"{s['label']}を届けられませんでした。内容を確かめて、もう一度送ってください")
+    st.session_state["_sends"] = waiting
+    if waiting:
+        oldest = min(s["ticket"].submitted_at for s in waiting)
+        slow = time.time() - oldest > 10
+        st.markdown(
+            f"<div class='tip'>📨 送信中：{len(waiting)}件"
+            + ("（通信が不安定です。つながりしだい自動で届けます）" if slow else "")
+            + "</div>",
+            unsafe_allow_html=True,
+        )
+
 def status_bar():
+    send_status()
     if st.session_state.get("flash_msg"):
         st.toast(st.session_state["flash_msg"])
         st.markdown(
@@ -1116,6 +1277,67 @@ def theme_selector():
             st.rerun()
 
 # ================== ログイン / 登録 ==================
+# ================== セッション再開トークン ==================
+# 再読み込みや通信切れで session_state が消えても、URL の ?s= に入れた署名付きトークンから
+# ログイン状態を戻す（Firestore は読まない）。中身は group_id / handle_norm / class_info・
+# HOME に出す連続日数（_checkin）と期限だけで、パスワードは入れない。期限は短めにして、使っている間は半分を過ぎたら出し直す。
+RESUME_PARAM = "s"
+RESUME_TTL_SEC = 8 * 3600
+
+def _b64url(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
+
+def make_resume_token(
+    group_id: str, handle_norm: str, class_info: Dict[str, str], exp: int, checkin: Optional[Tuple[str, int]] = None
+) -> str:
+    body = _b64url(json.dumps(
+        {"g": group_id, "h": handle_norm, "c": class_info, "k": checkin, "exp": exp},
+        ensure_ascii=False, separators=(",", ":"),
+    ).encode("utf-8"))
+    return f"{body}.{hmac_sha256_hex(APP_SECRET, f'resume:{body}')}"
+
+def read_resume_token(token: str) -> Optional[dict]:
+    """署名と期限が正しければ中身を返す"""
+    body, _, sig = (token or "").partition(".")
+    # bytes で比べる（str の compare_digest は ASCII 以外が混じると TypeError になる）
+    expected = hmac_sha256_hex(APP_SECRET, f"resume:{body}").encode()
+    if not body or not hmac.compare_digest(sig.encode("utf-8", "surrogatepass"), expected):
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(body + "=" * (-len(body) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or data.get("exp", 0) < time.time():
+        return None
+    return data
+
+def save_resume_token():
+    exp = int(time.time()) + RESUME_TTL_SEC
+    st.query_params[RESUME_PARAM] = make_resume_token(
+        st.session_state.group_id, st.session_state.handle_norm, st.session_state.class_info, exp,
+        st.session_state.get("_checkin"),
+    )
+    st.session_state["_resume_exp"] = exp
+
+def resume_session() -> bool:
+    """URL のトークンが有効ならログイン状態を戻す"""
+    data = read_resume_token(st.query_params.get(RESUME_PARAM, ""))
+    if data is None:
+        return False
+    st.session_state.group_id = data["g"]
+    st.session_state.handle_norm = data["h"]
+    st.session_state.user_disp = data["h"]
+    st.session_state.class_info = data.get("c") or {}
+    if data.get("k"):
+        st.session_state["_checkin"] = tuple(data["k"])
+    st.session_state.auth_ok = True
+    st.session_state["_resume_exp"] = data["exp"]
+    return True
+
+def refresh_resume_token():
+    if st.session_state.get("_resume_exp", 0) - time.time() < RESUME_TTL_SEC / 2:
+        save_resume_token()
+
 def login_register_ui() -> bool:
     st.markdown('<div class="card">', unsafe_allow_html=True)
     st.markdown("### 🌙 With You")
@@ -1157,6 +1379,9 @@ def login_register_ui() -> bool:
         err = handle_norm
 
     mode = st.session_state.mode
+    hint = ""
+    if mode == "REGISTER" and not err:
+        hint = handle_taken_hint(group_id_from_password(group_pw), handle_norm)
     btn_label = "はじめる" if mode == "REGISTER" else "入る"
     disabled = (err != "")
     
@@ -1176,23 +1401,33 @@ def login_register_ui() -> bool:
                 st.error(msg)
                 st.stop()
             
+            st.session_state["_checkin"] = ("", 0)
             st.session_state.auth_ok = True
+            save_resume_token()
             st.session_state.view = "HOME"
             st.session_state.flash_msg = f"{class_info['class_id']}へようこそ"
             st.rerun()
         else:
-            if not db_user_exists(gid, handle_norm):
+            try:
+                user = db_login(gid, handle_norm)
+            except Exception:
+                st.error("接続できませんでした。少し待ってからもう一度お試しください")
+                st.stop()
+            if user is None:
                 st.error("まだ登録がありません。「はじめての人」から設定できます")
                 st.stop()
             
-            db_touch_login(gid, handle_norm)
+            st.session_state["_checkin"] = checkin_state(user)
             st.session_state.auth_ok = True
+            save_resume_token()
             st.session_state.view = "HOME"
             st.session_state.flash_msg = "ログインしました"
             st.rerun()
 
     if err:
         st.caption(f"⚠️ {err}")
+    elif hint:
+        st.caption(f"💡 {hint}")
 
     st.markdown("</div>", unsafe_allow_html=True)
     return False
@@ -1201,6 +1436,7 @@ def logout_btn():
     with st.sidebar:
         if st.button("🚪 ログアウト", key="logout_btn"):
             keep = {"mode": st.session_state.get("mode","LOGIN")}
+            st.query_params.pop(RESUME_PARAM, None)
             st.session_state.clear()
             st.session_state.update(keep)
             st.rerun()
@@ -1210,7 +1446,8 @@ def home_intro():
     class_info = st.session_state.get("class_info", {})
     class_id = class_info.get("class_id", "")
     
-    streak = calculate_streak(st.session_state["_local_logs"]["note"])
+    # サーバーの記録（送った日）の連続日数と、この端末のノートの連続日数の長い方
+    streak = max(checkin_streak(st.session_state.get("_checkin")), calculate_streak(st.session_state["_local_logs"]))
     
     streak_html = ""
     if streak >= 3:
@@ -1368,10 +1605,11 @@ def view_share():
                 "memo": (memo or "").strip(),
             },
             "risk_level": risk_level,
+            "risk_version": RISK_CLASSIFIER_VERSION,
             "anonymous": True
         }
         
-        ok = safe_db_add("school_share", payload)
+        ok = safe_db_add_share(payload)
         
         if ok:
             st.balloons()
@@ -1442,9 +1680,12 @@ def view_consult():
             "anonymous": bool(anonymous),
             "name": name.strip() if (not anonymous and name) else "",
             "risk_level": risk_level,
+            # 管理画面の並び順用（本文だけで決める。保存していない古い相談も管理画面が同じ規則で判定する）
+            "msg_priority": message_priority(msg.strip()),
+            "risk_version": RISK_CLASSIFIER_VERSION,
         }
         
-        ok = safe_db_add("consult_msgs", payload)
+        ok = safe_db_add("consult_msgs", payload, "相談")
         
         if ok:
             st.balloons()
@@ -1459,80 +1700,39 @@ def view_consult():
 # ----- リラックス（呼吸）-----
 BREATH_PATTERN = (5, 2, 6)
 
-def breathing_animation(total_sec: int = 90):
-    """呼吸ワークのアニメーション"""
-    st.session_state["_breath_running"] = True
+BREATH_TIMER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "breath_timer")
+breath_timer = components.declare_component("breath_timer", path=BREATH_TIMER_DIR)
 
+def breathing_animation(total_sec: int = 90):
+    """呼吸ワークのアニメーション（サイクル・カウントダウン・停止ボタンはブラウザ側で動く）"""
     inhale, hold, exhale = BREATH_PATTERN
     cycle = inhale + hold + exhale
     cycles = max(1, round(total_sec / cycle))
 
-    circle_area = st.empty()
-    phase_area = st.empty()
-    countdown_area = st.empty()
-    stop_area = st.empty()
-
-    def render_circle(phase_class: str = ""):
-        circle_area.markdown(
-            f"""
-<div class="breath-container">
-  <div class="breath-spot {phase_class}"></div>
-</div>
-""",
-            unsafe_allow_html=True,
-        )
-
-    def set_countdown(sec: int, label: str = ""):
-        countdown_area.markdown(
-            f"""
-<div style="text-align:center;font-size:0.95rem;color:var(--text-secondary);margin-top:10px;font-weight:300;">
-  {label} のこり <b style="color:var(--accent-soft)">{sec}</b> 秒
-</div>
-""",
-            unsafe_allow_html=True,
+    started_at = st.session_state.get("_breath_started_at") or time.time()
+    elapsed = time.time() - started_at
+    if elapsed >= cycles * cycle:
+        # 途中で別の画面に移っている間に終わっていた
+        result = {"status": "finished", "elapsed": cycles * cycle}
+    else:
+        theme = THEMES[st.session_state.get("theme", "🌙 静かな夜空")]
+        result = breath_timer(
+            inhale=inhale,
+            hold=hold,
+            exhale=exhale,
+            cycles=cycles,
+            elapsed=elapsed,
+            accent=theme["accent"],
+            accent_soft=theme["accent_soft"],
+            key=f"breath_timer_{int(started_at * 1000)}",
+            default=None,
         )
 
-    with stop_area.container():
-        cols = st.columns([1, 1, 1])
-        with cols[1]:
-            st.button(
-                "⏹ 停止する",
-                key="breath_stop_btn",
-                on_click=lambda: st.session_state.update({"_breath_stop": True}),
-                use_container_width=True,
-            )
-
-    try:
-        for _ in range(cycles):
-            phases = [
-                ("吸ってください", inhale, "inhale"), 
-                ("止めてください", hold, "hold"), 
-                ("吐いてください", exhale, "exhale")
-            ]
-            
-            for label, seconds, phase_class in phases:
-                if seconds <= 0:
-                    continue
-                
-                render_circle(phase_class)
-                phase_area.markdown(
-                    f"<div style='text-align:center;font-size:1.1rem;font-weight:500;color:var(--accent-soft);'>{label}</div>", 
-                    unsafe_allow_html=True
-                )
-                
-                for remain in range(seconds, 0, -1):
-                    if st.session_state.get("_breath_stop") or st.session_state.view != "SESSION":
-                        return
-                    set_countdown(remain, label)
-                    time.sleep(1)
-    finally:
-        phase_area.empty()
-        countdown_area.empty()
-        stop_area.empty()
-        circle_area.empty()
+    if result:
         st.session_state["_breath_running"] = False
-        st.session_state["_breath_stop"] = False
         st.session_state["_breath_finished"] = True
+        st.session_state["_breath_last_sec"] = int(result.get("elapsed") or 0)
+        st.session_state.pop("_breath_started_at", None)
         st.rerun()
 
 def view_session():
@@ -1557,8 +1757,8 @@ def view_session():
                 type="primary", 
                 use_container_width=True
             ):
-                st.session_state["_breath_stop"] = False
                 st.session_state["_breath_running"] = True
+                st.session_state["_breath_started_at"] = time.time()
                 st.rerun()
     else:
         breathing_animation(total_seconds)
@@ -1573,12 +1773,13 @@ def view_session():
     )
 
     if st.button("💾 端末に保存", type="primary", key="breath_save"):
-        st.session_state["_local_logs"]["breath"].append({
-            "ts": now_iso(), 
-            "pattern": "5-2-6", 
-            "mood_after": int(after), 
-            "sec": total_seconds
-        })
+        st.session_state["_local_logs"].add(
+            "breath",
+            ts=epoch_now(),
+            pattern="5-2-6",
+            mood_after=int(after),
+            sec=int(st.session_state.get("_breath_last_sec", total_seconds)),
+        )
         st.balloons()
         st.success("保存しました")
 
@@ -1591,6 +1792,7 @@ MOODS = [
     {"emoji":"😩","label":"しんどい","key":"tired"},
     {"emoji":"😕","label":"モヤモヤ","key":"confuse"},
 ]
+MOOD_BY_KEY = {m["key"]: m for m in MOODS}
 
 def cbt_intro_block():
     st.markdown("""
@@ -1739,18 +1941,22 @@ def view_note():
     )
 
     if st.button("💾 端末に保存", type="primary", key="cbt_save"):
-        doc = {
-            "ts": now_iso(),
-            "mood": mood,
-            "trigger": (trigger_text or "").strip(),
-            "auto": (auto_thought or "").strip(),
-            "reason_for": (reason_for or "").strip(),
-            "reason_against": (reason_against or "").strip(),
-            "alt_perspective": (alt_perspective or "").strip(),
-            "action": {"suggested": act_suggested, "custom": act_custom},
-            "diary": (reflection or "").strip(),
-        }
-        st.session_state["_local_logs"]["note"].append(doc)
+        logs = st.session_state["_local_logs"]
+        rec = logs.add(
+            "note",
+            ts=epoch_now(),
+            mood=mood.get("key"),
+            intensity=int(mood.get("intensity") or 0),
+            trigger=(trigger_text or "").strip(),
+            auto=(auto_thought or "").strip(),
+            reason_for=(reason_for or "").strip(),
+            reason_against=(reason_against or "").strip(),
+            alt_perspective=(alt_perspective or "").strip(),
+            action_suggested=act_suggested,
+            action_custom=act_custom,
+            diary=(reflection or "").strip(),
+        )
+        doc = note_to_dict(rec)
         st.balloons()
         st.success("保存しました")
         
@@ -1759,43 +1965,19 @@ def view_note():
             data=json.dumps(doc, ensure_ascii=False, indent=2).encode("utf-8"),
             file_name=f"note_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
             mime="application/json",
-            key=f"dl_note_{len(st.session_state['_local_logs']['note'])}"
+            key=f"dl_note_{logs.count('note')}"
         )
 
 # ----- Study Tracker【強化版＋ゲーミフィケーション】 -----
-def calculate_study_stats(studies: List[Dict]) -> Dict[str, Any]:
-    """学習統計を計算"""
-    if not studies:
-        return {
-            "total_minutes": 0,
-            "weekly_minutes": 0,
-            "monthly_minutes": 0,
-            "by_subject": {},
-            "weekly_progress": 0,
-            "monthly_progress": 0
-        }
-    
-    df = pd.DataFrame(studies)
-    df['ts'] = pd.to_datetime(df['ts'])
-    
-    now = datetime.now()
-    week_ago = now - timedelta(days=7)
-    month_ago = now - timedelta(days=30)
-    
-    total = df['minutes'].sum()
-    weekly = df[df['ts'] >= week_ago]['minutes'].sum()
-    monthly = df[df['ts'] >= month_ago]['minutes'].sum()
-    
-    by_subject = df.groupby('subject')['minutes'].sum().to_dict()
+def calculate_study_stats(logs: LocalLog) -> Dict[str, Any]:
+    """学習統計（LocalLog が記録のたびに足している集計を読むだけ）"""
+    stats = logs.study_stats.snapshot(epoch_now())
+    weekly, monthly = stats["weekly_minutes"], stats["monthly_minutes"]
     
     weekly_goal = st.session_state.get("study_weekly_goal", 300)
     monthly_goal = st.session_state.get("study_monthly_goal", 1200)
     
-    return {
-        "total_minutes": int(total),
-        "weekly_minutes": int(weekly),
-        "monthly_minutes": int(monthly),
-        "by_subject": by_subject,
+    return stats | {
         "weekly_progress": min(100, int((weekly / weekly_goal) * 100)) if weekly_goal > 0 else 0,
         "monthly_progress": min(100, int((monthly / monthly_goal) * 100)) if monthly_goal > 0 else 0,
     }
@@ -1804,8 +1986,7 @@ def view_study():
     st.markdown("### 📚 Study Tracker")
     st.caption("学習時間を記録して、自分の成長を確かめよう")
     
-    studies = st.session_state["_local_logs"]["study"]
-    stats = calculate_study_stats(studies)
+    stats = calculate_study_stats(st.session_state["_local_logs"])
     level = get_study_level(stats["total_minutes"])
     
     if stats["total_minutes"] > 0:
@@ -1904,15 +2085,15 @@ def view_study():
     )
     
     if st.button("💾 記録する", type="primary", key="study_save"):
-        rec = {
-            "ts": now_iso(), 
-            "subject": subj, 
-            "minutes": int(mins),
-            "understanding": understanding,
-            "concentration": concentration,
-            "memo": memo
-        }
-        st.session_state["_local_logs"]["study"].append(rec)
+        st.session_state["_local_logs"].add(
+            "study",
+            ts=epoch_now(),
+            subject=subj,
+            minutes=int(mins),
+            understanding=understanding,
+            concentration=concentration,
+            memo=memo,
+        )
         st.balloons()
         st.success("記録しました")
         st.rerun()
@@ -1924,12 +2105,12 @@ def view_review():
     
     logs = st.session_state["_local_logs"]
     
-    streak = calculate_streak(logs["note"])
+    streak = calculate_streak(logs)
     if streak > 0:
         st.markdown(f'<div class="badge">🔥 {streak}日連続記録中</div>', unsafe_allow_html=True)
     
-    if any(len(v)>0 for v in logs.values()):
-        all_json = json.dumps(logs, ensure_ascii=False, indent=2).encode("utf-8")
+    if logs:
+        all_json = json.dumps(export_logs(logs), ensure_ascii=False, indent=2).encode("utf-8")
         st.download_button(
             "⬇️ すべての記録をダウンロード", 
             data=all_json,
@@ -1938,10 +2119,14 @@ def view_review():
             key="review_dl_all"
         )
     
+    older = sum(logs.spilled.values())
+    if older:
+        st.caption(f"古い記録 {older}件は一覧から外しました（ダウンロードには含まれます）")
+    
     tabs = st.tabs(["ノート","呼吸","Study"])
     
     with tabs[0]:
-        notes = list(reversed(logs["note"]))
+        notes = [note_to_dict(r) for r in reversed(logs.recent("note"))]
         if not notes: 
             st.caption("まだ記録がありません")
         else:
@@ -1950,7 +2135,7 @@ def view_review():
 <div class="item">
   <div class="meta">{r['ts']}</div>
   <div style="font-weight:500; color:var(--accent-soft); margin-bottom:.2rem">
-    {r['mood'].get('emoji','')} {r['mood'].get('label','')}
+    {r['mood'].get('emoji') or ''} {r['mood'].get('label') or ''}
   </div>
   <div style="white-space:pre-wrap; margin-bottom:.3rem; font-size:0.88rem">きっかけ：{r.get('trigger','')}</div>
   <div style="white-space:pre-wrap; margin-bottom:.3rem; font-size:0.88rem">頭の中の言葉：{r.get('auto','')}</div>
@@ -1959,11 +2144,14 @@ def view_review():
 """, unsafe_allow_html=True)
     
     with tabs[1]:
-        breaths = list(reversed(logs["breath"]))
+        breaths = [rec_to_dict(r) for r in reversed(logs.recent("breath"))]
         if not breaths: 
             st.caption("まだ記録がありません")
         else:
             if len(breaths) >= 2:
+                import pandas as pd
+                import altair as alt
+                
                 st.markdown("#### 📈 気分の推移")
                 df = pd.DataFrame(breaths)
                 df['date'] = pd.to_datetime(df['ts']).dt.date
@@ -1987,11 +2175,11 @@ def view_review():
 """, unsafe_allow_html=True)
     
     with tabs[2]:
-        studies = list(reversed(logs["study"]))
+        studies = [rec_to_dict(r) for r in reversed(logs.recent("study"))]
         if not studies: 
             st.caption("まだ記録がありません")
         else:
-            stats = calculate_study_stats(logs["study"])
+            stats = calculate_study_stats(logs)
             if stats["total_minutes"] > 0:
                 st.markdown("#### 📊 学習統計")
                 hours = stats["total_minutes"] / 60
@@ -2039,7 +2227,8 @@ def main_router():
         view_home()
 
 # ================== アプリ起動 ==================
-if st.session_state.get("auth_ok", False):
+if st.session_state.get("auth_ok", False) or resume_session():
+    refresh_resume_token()
     logout_btn()
     theme_selector()
     status_bar()
@@ -0,0 +1,156 @@
+# benchmarks/admin_frames.py — 管理画面の DataFrame 組み立て（make_share_df / make_consult_df）の計測
+#
+# 1 行ずつ dict を作っていた以前の組み立て方（rowwise）と、列ごとに組み立てる今の
+# admin_app の実装（columnar）とで、N 行の組み立て時間とできた DataFrame のメモリを比べる。
+# 両者の結果（値）が同じであることも確かめる。
+#
+#   python benchmarks/admin_frames.py --rows 10000 100000 1000000
+
+from __future__ import annotations
+import argparse, os, random, sys, time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("WITHYOU_STORAGE", "memory")
+import pandas as pd  # noqa: E402
+import admin_app  # noqa: E402
+from risk import RISK_CLASSIFIER_VERSION  # noqa: E402
+
+MOODS = ["😟", "😐", "🙂"]
+BODY = ["なし", "頭痛", "腹痛", "だるい"]
+TOPICS = ["体調", "勉強", "人間関係", "家庭", "進路"]
+
+
+# ---------- 以前の組み立て方（比較用にそのまま残したもの） ----------
+def payload_series(v: dict, key: str, default=None):
+    if not isinstance(v, dict):
+        return default
+    return (v.get("payload", {}) or {}).get(key, default)
+
+
+def rowwise_share_df(rows):
+    df = pd.DataFrame(
+        [
+            {
+                "ts": r.get("ts"),
+                "group_id": r.get("group_id", ""),
+                "mood": payload_series(r, "mood"),
+                "sleep_hours": payload_series(r, "sleep_hours"),
+                "sleep_quality": payload_series(r, "sleep_quality"),
+                "body": payload_series(r, "body", []),
+            }
+            for r in rows
+        ]
+    )
+    df["ts"] = pd.to_datetime(df["ts"], utc=True, errors="coerce")
+    df["date"] = df["ts"].dt.date
+    df["has_body"] = df["body"].apply(lambda x: int(any((b != "なし") for b in (x or []))))
+    df["is_low"] = (df["mood"] == "😟").astype(int)
+    return df
+
+
+def rowwise_consult_df(rows):
+    rows = [r for r in rows if isinstance(r.get("ts"), datetime)]
+    df = pd.DataFrame(
+        [
+            {
+                "id": r.get("id"),
+                "ts": r.get("ts"),
+                "group_id": r.get("group_id", ""),
+                "topics": ",".join(r.get("topics", []) or []),
+                "intent": r.get("intent", ""),
+                "anonymous": r.get("anonymous", True),
+            }
+            for r in rows
+        ]
+    )
+    df["ts"] = pd.to_datetime(df["ts"], utc=True, errors="coerce")
+    df["date"] = df["ts"].dt.date
+    # 以前の consult_priorities（保存済みの判定を 1 行ずつ確かめる）
+    out = []
+    for r in rows:
+        if r.get("risk_version") == RISK_CLASSIFIER_VERSION and r.get("msg_priority"):
+            out.append(r["msg_priority"])
+            continue
+        out.append(None)
+    df["priority"] = out
+    return df.sort_values("ts", kind="stable", ignore_index=True)
+
+
+# ---------- データ ----------
+def share_rows(n: int):
+    rnd = random.Random(1)
+    t0 = datetime.now(timezone.utc) - timedelta(days=60)
+    return [
+        {
+            "id": f"s{i}",
+            "ts": t0 + timedelta(seconds=i * 5),
+            "group_id": f"g{rnd.randrange(30)}",
+            "payload": {
+                "mood": rnd.choice(MOODS),
+                "sleep_hours": rnd.choice([4.5, 6.0, 7.5, 8.0]),
+                "sleep_quality": rnd.choice(["ぐっすり", "ふつう", "浅い"]),
+                "body": rnd.sample(BODY, rnd.randrange(1, 3)),
+            },
+        }
+        for i in range(n)
+    ]
+
+
+def consult_rows(n: int):
+    rnd = random.Random(2)
+    t0 = datetime.now(timezone.utc) - timedelta(days=60)
+    return [
+        {
+            "id": f"c{i}",
+            "ts": t0 + timedelta(seconds=i * 5),
+            "group_id": f"g{rnd.randrange(30)}",
+            "topics": rnd.sample(TOPICS, rnd.randrange(1, 3)),
+            "intent": rnd.choice(["先生", "スクールカウンセラー", "保健室"]),
+            "anonymous": rnd.random() < 0.8,
+            "msg_priority": rnd.choice(["low", "low", "medium", "urgent"]),
+            "risk_version": RISK_CLASSIFIER_VERSION,  # 保存済みの判定（判定器は呼ばない）
+        }
+        for i in range(n)
+    ]
+
+
+def same(a: pd.DataFrame, b: pd.DataFrame, cols):
+    for c in cols:
+        x, y = a[c], b[c]
+        if isinstance(x.dtype, pd.CategoricalDtype) or isinstance(y.dtype, pd.CategoricalDtype):
+            x, y = x.astype(object), y.astype(object)
+        if c == "id":
+            x, y = x.astype(object), y.astype(object)
+        pd.testing.assert_series_equal(x, y, check_dtype=False, check_names=False)
+
+
+def timed(fn, rows):
+    t0 = time.perf_counter()
+    df = fn(rows)
+    return time.perf_counter() - t0, df
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = ap.parse_args()
+    print(f"{'':16} {'rows':>9} {'rowwise(s)':>11} {'columnar(s)':>12} {'speedup':>8} {'MB before':>10} {'MB after':>9}")
+    for n in args.rows:
+        for name, make_rows, old, new, cols in [
+            ("make_share_df", share_rows, rowwise_share_df, admin_app.make_share_df,
+             ["ts", "group_id", "mood", "sleep_hours", "sleep_quality", "date", "has_body", "is_low"]),
+            ("make_consult_df", consult_rows, rowwise_consult_df, admin_app.make_consult_df,
+             ["id", "ts", "group_id", "topics", "intent", "anonymous", "date", "priority"]),
+        ]:
+            rows = make_rows(n)
+            t_old, df_old = timed(old, rows)
+            t_new, df_new = timed(new, rows)
+            same(df_old, df_new, cols)
+            mb_old = df_old[cols].memory_usage(deep=True).sum() / 1e6
+            mb_new = df_new[cols].memory_usage(deep=True).sum() / 1e6
+            print(f"{name:16} {n:>9} {t_old:>11.2f} {t_new:>12.2f} {t_old / t_new:>7.1f}x {mb_old:>10.1f} {mb_new:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# benchmarks/burst.py — 朝の一斉チェックイン（同時送信）の書き込みコスト計測
+#
+# N 人が同時に「送る」を押したときの
+#   - 全員の送信が終わるまでの時間
+#   - 1 人あたりの待ち時間（中央値 / 最大）
+#   - バックエンドへのコミット回数
+# を、1 件ずつ直接コミットする場合と BatchWriter でまとめる場合とで比べる。
+# バックエンドは MemoryStorage に往復遅延（--rtt ミリ秒）を足したもの。
+#
+#   python benchmarks/burst.py --students 300 --rtt 30
+
+from __future__ import annotations
+import argparse, os, statistics, sys, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import Increment, MemoryStorage, Write, new_id  # noqa: E402
+from writer import BatchWriter  # noqa: E402
+
+
+class SlowStorage(MemoryStorage):
+    """コミット 1 回ごとに往復遅延を足す。別々のコミットは並行に進むが、
+    Firestore と同じく同じ doc（日次ロールアップ）への書き込みは 1 つずつしか通らない。"""
+
+    def __init__(self, rtt: float):
+        super().__init__()
+        self.rtt = rtt
+        self.doc_locks = {}
+        self.guard = threading.Lock()
+
+    def commit(self, writes):
+        with self.guard:
+            locks = [self.doc_locks.setdefault(p, threading.Lock()) for p in sorted({w.path for w in writes})]
+        for lk in locks:
+            lk.acquire()
+        try:
+            time.sleep(self.rtt)
+            super().commit(writes)
+        finally:
+            for lk in locks:
+                lk.release()
+
+
+def share_writes(i: int):
+    return [
+        Write("create", f"school_share/{new_id()}", {"i": i, "mood": "🙂"}),
+        Write("merge", "share_daily/g_2025-01-01", {"n": Increment(1)}),
+    ]
+
+
+def run(students: int, rtt: float, batched: bool) -> dict:
+    db = SlowStorage(rtt)
+    bw = BatchWriter(db) if batched else None
+    waits = []
+    lock = threading.Lock()
+    start = threading.Barrier(students + 1)
+
+    def student(i: int):
+        start.wait()
+        t0 = time.perf_counter()
+        if bw is not None:
+            bw.submit(share_writes(i)).wait()
+        else:
+            db.commit(share_writes(i))
+        with lock:
+            waits.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=student, args=(i,)) for i in range(students)]
+    for t in threads:
+        t.start()
+    t0 = time.perf_counter()
+    start.wait()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - t0
+    assert db.colls["share_daily"]["g_2025-01-01"]["n"] == students
+    return {
+        "total_s": round(total, 2),
+        "p50_ms": round(statistics.median(waits) * 1000),
+        "max_ms": round(max(waits) * 1000),
+        "commits": db.stats["commits"],
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--students", type=int, default=300)
+    ap.add_argument("--rtt", type=float, default=30, help="1 コミットの往復遅延（ミリ秒）")
+    args = ap.parse_args()
+    print(f"{args.students} students, rtt {args.rtt:.0f} ms")
+    print(f"{'':18} {'total(s)':>9} {'p50(ms)':>8} {'max(ms)':>8} {'commits':>8}")
+    for name, batched in [("direct", False), ("BatchWriter", True)]:
+        r = run(args.students, args.rtt / 1000, batched)
+        print(f"{name:18} {r['total_s']:>9} {r['p50_ms']:>8} {r['max_ms']:>8} {r['commits']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# benchmarks/session_memory.py — 1 セッションが抱える「端末保存」の記録の大きさ
+#
+# ノート・呼吸・Study を N 件ずつ記録したときの 1 セッションあたりのバイト数を、
+# これまでの dict のリストと locallog.LocalLog（NamedTuple・intern・件数上限）とで比べる。
+# 最後に --sessions 個のセッションを同時に生かしたときの locallog.memory_report()（プロセス全体の見積もり）を出す。
+#
+#   python benchmarks/session_memory.py --records 50 100 500 2000 --sessions 300
+
+from __future__ import annotations
+import argparse, os, sys, time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from locallog import LocalLog, memory_report  # noqa: E402
+
+MOODS = [("joy", "うれしい", "😊"), ("anx", "不安", "😟"), ("tired", "つかれた", "😪")]
+SUBJECTS = ["数学", "英語", "国語", "理科", "社会"]
+
+
+def deep_size(o, seen=None) -> int:
+    seen = set() if seen is None else seen
+    if id(o) in seen:
+        return 0
+    seen.add(id(o))
+    n = sys.getsizeof(o)
+    if isinstance(o, dict):
+        n += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in o.items())
+    elif isinstance(o, (list, tuple)):
+        n += sum(deep_size(v, seen) for v in o)
+    return n
+
+
+def fill_dicts(n: int) -> dict:
+    logs = {"note": [], "breath": [], "study": []}
+    for i in range(n):
+        ts = datetime.now(timezone.utc).astimezone().isoformat(timespec="seconds")
+        key, label, emoji = MOODS[i % len(MOODS)]
+        logs["note"].append({
+            "ts": ts,
+            "mood": {"key": key, "label": label, "emoji": emoji, "intensity": 3},
+            "trigger": f"テスト前で {i}", "auto": "できない気がする", "reason_for": "", "reason_against": "",
+            "alt_perspective": "", "action": {"suggested": "深呼吸", "custom": ""}, "diary": "まあまあ",
+        })
+        logs["breath"].append({"ts": ts, "pattern": "5-2-6", "mood_after": 5, "sec": 90})
+        logs["study"].append({
+            "ts": ts, "subject": SUBJECTS[i % len(SUBJECTS)], "minutes": 30,
+            "understanding": "普通", "concentration": "集中", "memo": "",
+        })
+    return logs
+
+
+def fill_locallog(n: int) -> LocalLog:
+    logs = LocalLog()
+    for i in range(n):
+        ts = int(time.time())
+        logs.add("note", ts=ts, mood=MOODS[i % len(MOODS)][0], intensity=3, trigger=f"テスト前で {i}",
+                 auto="できない気がする", reason_for="", reason_against="", alt_perspective="",
+                 action_suggested="深呼吸", action_custom="", diary="まあまあ")
+        logs.add("breath", ts=ts, pattern="5-2-6", mood_after=5, sec=90)
+        logs.add("study", ts=ts, subject=SUBJECTS[i % len(SUBJECTS)], minutes=30,
+                 understanding="普通", concentration="集中", memo="")
+    return logs
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--records", type=int, nargs="+", default=[50, 100, 500, 2000], help="種類ごとの件数")
+    ap.add_argument("--sessions", type=int, default=300, help="同時に生かすセッション数（memory_report 用）")
+    args = ap.parse_args()
+    print(f"{'records':>8} {'dict(KB)':>9} {'LocalLog(KB)':>13} {'spilled':>8}")
+    for n in args.records:
+        d = deep_size(fill_dicts(n))
+        logs = fill_locallog(n)
+        print(f"{n:>8} {d / 1024:>9.1f} {logs.nbytes() / 1024:>13.1f} {sum(logs.spilled.values()):>8}")
+    del logs
+
+    # セッションごとに記録の多さが違う状態で、全セッションの合計・平均・p95 を見る
+    alive = [fill_locallog(args.records[i % len(args.records)]) for i in range(args.sessions)]
+    report = memory_report()
+    print()
+    for k, v in report.items():
+        print(f"{k:>16} {v / 1024:>10.1f} KB" if k.endswith("_bytes") else f"{k:>16} {v:>10}")
+    del alive
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# benchmarks/startup.py — 生徒アプリ(app.py)のログイン画面までの起動コスト計測
+#
+# 新しいプロセスで app.py のログイン画面を 1 回描画し、
+#   - import streamlit にかかった時間
+#   - app.py の初回実行（ログイン画面の描画）にかかった時間
+#   - そのときに読み込まれていた重いライブラリ
+#   - 最大 RSS
+# を表示する。"before" は pandas / altair を先に import して、
+# 以前のトップレベル import と同じ状態を再現したもの。
+#
+#   python benchmarks/startup.py
+#
+# Firestore の接続情報が無くても動く（未接続としてログイン画面が出る）。
+
+from __future__ import annotations
+import json, os, subprocess, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ["pandas", "altair", "numpy", "pyarrow"]
+
+
+def measure(eager: bool) -> dict:
+    import resource
+
+    t0 = time.perf_counter()
+    if eager:
+        import pandas  # noqa: F401
+        import altair  # noqa: F401
+    import streamlit  # noqa: F401
+    from streamlit.testing.v1 import AppTest
+
+    t1 = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    at.secrets["APP_SECRET"] = "bench"
+    at.run()
+    t2 = time.perf_counter()
+    if at.exception:
+        raise SystemExit(at.exception[0].message)
+    return {
+        "import_s": round(t1 - t0, 3),
+        "login_page_s": round(t2 - t1, 3),
+        "loaded": [m for m in HEAVY if m in sys.modules],
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_child(eager: bool) -> dict:
+    cmd = [sys.executable, os.path.abspath(__file__), "--child"] + (["--eager"] if eager else [])
+    out = subprocess.run(cmd, capture_output=True, text=True, check=True, cwd=ROOT).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    if "--child" in sys.argv:
+        print(json.dumps(measure("--eager" in sys.argv)))
+        return
+    rows = [("before (eager pandas/altair)", run_child(True)), ("after (lazy)", run_child(False))]
+    print(f"{'':30} {'import(s)':>10} {'login(s)':>10} {'RSS(MB)':>9}  loaded")
+    for name, r in rows:
+        print(
+            f"{name:30} {r['import_s']:>10} {r['login_page_s']:>10} {r['max_rss_mb']:>9}  "
+            f"{','.join(r['loaded']) or '-'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# handles.py — With You. 使用済みニックネームの確率的フィルタ（登録画面の即時チェック用）
+#
+# groups/{gid}/users の doc ID（handle_norm）をグループごとの Bloom フィルタに入れておき、
+# 入力中のニックネームが「たぶん使われている」かを Firestore を読まずに答える。
+# Bloom フィルタは「入っていない」は確実、「入っている」はまれに誤る（既定 1%）ので、
+# 画面では注意を出すだけにして、最終判定はこれまで通り db_create_user の create で行う。
+#
+# 読み込みは created_at だけの射影クエリ。初回は全件、以降は created_at の最高水位より新しい分だけ。
+# 想定より人数が増えて誤判定率が上がったら、大きいフィルタで全件から作り直す。
+
+from __future__ import annotations
+from datetime import datetime, timedelta
+from typing import Optional
+import hashlib, math, threading, time
+
+from storage import Storage
+
+FETCH_PAGE_SIZE = 500
+# created_at は書き込む側の時計なので、最高水位より少し前から読み直して取りこぼしを防ぐ
+REFRESH_OVERLAP = timedelta(minutes=5)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int = 256, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.m = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.k = max(1, round(self.m / capacity * math.log(2)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # 128bit のダイジェストを 2 つに割って k 個の位置を作る（Kirsch–Mitzenmacher）
+        d = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(d[:8], "little")
+        h2 = int.from_bytes(d[8:], "little") | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def add(self, item: str):
+        pos = self._positions(item)
+        if all(self.bits[p >> 3] & (1 << (p & 7)) for p in pos):
+            return
+        for p in pos:
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    @property
+    def full(self) -> bool:
+        return self.count > self.capacity
+
+
+class TakenHandles:
+    """1 グループぶんの使用済みニックネーム。refresh_sec ごとに差分だけ読み足す。"""
+
+    def __init__(self, db: Storage, group_id: str, refresh_sec: float = 30.0, capacity: int = 256):
+        self.db = db
+        self.coll = f"groups/{group_id}/users"
+        self.refresh_sec = refresh_sec
+        self.bloom = BloomFilter(capacity)
+        self.high_water: Optional[datetime] = None
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+    def _load(self, since: Optional[datetime]):
+        where = [("created_at", ">=", since)] if since is not None else []
+        last = None
+        while True:
+            # start_after のカーソルに created_at が要るので、射影にも created_at を入れる
+            docs = self.db.query(
+                self.coll,
+                where=where,
+                order_by="created_at",
+                limit=FETCH_PAGE_SIZE,
+                start_after=last,
+                select=["created_at"],
+            )
+            for d in docs:
+                self.bloom.add(d.id)
+            if docs:
+                ts = docs[-1].data.get("created_at")
+                if self.high_water is None or ts > self.high_water:
+                    self.high_water = ts
+            if len(docs) < FETCH_PAGE_SIZE:
+                return
+            last = docs[-1]
+
+    def refresh(self):
+        self._load(self.high_water - REFRESH_OVERLAP if self.high_water else None)
+        if self.bloom.full:
+            # 想定人数を超えたら 4 倍の大きさで全件から作り直す
+            self.bloom = BloomFilter(self.bloom.capacity * 4)
+            self.high_water = None
+            self._load(None)
+        self.refreshed_at = time.time()
+
+    def probably_taken(self, handle_norm: str) -> bool:
+        with self.lock:
+            if time.time() - self.refreshed_at >= self.refresh_sec:
+                self.refresh()
+            return handle_norm in self.bloom
+
+    def add(self, handle_norm: str):
+        """登録できた・create が競合したときに呼ぶ（次の差分読み込みを待たずに反映）。"""
+        with self.lock:
+            self.bloom.add(handle_norm)
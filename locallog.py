@@ -0,0 +1,228 @@
+# locallog.py — With You. セッション内の記録（ノート・呼吸・Study）のコンパクトな置き場
+#
+# 「端末に保存」した記録はセッションが続く間サーバーのメモリに残るので、
+#   - 1 件 = NamedTuple（dict より小さい）、時刻は epoch 秒の int
+#   - 気分・科目・理解度などの選択肢は sys.intern で全セッション共通の 1 つの文字列にする
+#   - 種類ごとに max_records 件を超えたら古い方からまとめて一時ファイルに逃がす
+#     （TemporaryFile は作った時点で名前が消えるので、セッションが捨てられれば一緒に消える）
+# で 1 セッションあたりの大きさに上限を付ける。逃がした分もダウンロード（all()）には含まれる。
+# memory_report() で今生きているセッションのバイト数をまとめて見られる（benchmarks/session_memory.py が出す）。
+#
+# Study の集計（合計・科目別・直近 7 日 / 30 日）は add のたびに StudyStats に足していくので、
+# 画面の再実行ごとに全件を読み直さない（一時ファイルに逃がした分も集計には入っている）。
+# ノートの連続記録日数も同じく Streak（最後の日付と連続日数）を add のたびに進める。
+
+from __future__ import annotations
+from collections import Counter, deque
+from datetime import date, datetime, tzinfo
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+import bisect, json, os, sys, tempfile, time, weakref
+
+LOCAL_LOG_MAX = int(os.environ.get("WITHYOU_LOCAL_LOG_MAX") or 200)
+
+
+class NoteRec(NamedTuple):
+    ts: int
+    mood: str  # MOODS の key
+    intensity: int
+    trigger: str
+    auto: str
+    reason_for: str
+    reason_against: str
+    alt_perspective: str
+    action_suggested: str
+    action_custom: str
+    diary: str
+
+
+class BreathRec(NamedTuple):
+    ts: int
+    pattern: str
+    mood_after: int
+    sec: int
+
+
+class StudyRec(NamedTuple):
+    ts: int
+    subject: str
+    minutes: int
+    understanding: str
+    concentration: str
+    memo: str
+
+
+KINDS = {"note": NoteRec, "breath": BreathRec, "study": StudyRec}
+ENUM_FIELDS = {"note": ("mood",), "breath": ("pattern",), "study": ("subject", "understanding", "concentration")}
+
+_LIVE: "weakref.WeakSet[LocalLog]" = weakref.WeakSet()
+
+
+def epoch_now() -> int:
+    return int(time.time())
+
+
+# ================== Study の集計 ==================
+class Window:
+    """直近 span 秒の合計。(ts, 分) を秒単位のバケツにして古い順に持ち、期限切れを左から捨てる。"""
+
+    def __init__(self, span: int):
+        self.span = span
+        self.ring: deque = deque()  # [ts, 分]
+        self.total = 0
+
+    def add(self, ts: int, minutes: int):
+        if self.ring and ts < self.ring[-1][0]:
+            # 端末の時計が戻ったときだけ。順番を保って差し込む
+            i = bisect.bisect_right([b[0] for b in self.ring], ts)
+            if i and self.ring[i - 1][0] == ts:
+                self.ring[i - 1][1] += minutes
+            else:
+                self.ring.insert(i, [ts, minutes])
+        elif self.ring and ts == self.ring[-1][0]:
+            self.ring[-1][1] += minutes
+        else:
+            self.ring.append([ts, minutes])
+        self.total += minutes
+
+    def since(self, cutoff: int) -> int:
+        """ts >= cutoff の合計（cutoff は前回以上であること）。"""
+        while self.ring and self.ring[0][0] < cutoff:
+            self.total -= self.ring.popleft()[1]
+        return self.total
+
+
+class StudyStats:
+    WEEK_SEC = 7 * 86400
+    MONTH_SEC = 30 * 86400
+
+    def __init__(self):
+        self.total = 0
+        self.by_subject: Dict[str, int] = {}
+        self.week = Window(self.WEEK_SEC)
+        self.month = Window(self.MONTH_SEC)
+
+    def add(self, rec: "StudyRec"):
+        self.total += rec.minutes
+        self.by_subject[rec.subject] = self.by_subject.get(rec.subject, 0) + rec.minutes
+        now = epoch_now()
+        if rec.ts >= now - self.MONTH_SEC:
+            self.month.add(rec.ts, rec.minutes)
+            if rec.ts >= now - self.WEEK_SEC:
+                self.week.add(rec.ts, rec.minutes)
+
+    def snapshot(self, now: int) -> Dict[str, Any]:
+        return {
+            "total_minutes": self.total,
+            "weekly_minutes": self.week.since(now - self.WEEK_SEC),
+            "monthly_minutes": self.month.since(now - self.MONTH_SEC),
+            "by_subject": dict(sorted(self.by_subject.items())),
+        }
+
+
+# ================== 連続記録日数 ==================
+class Streak:
+    """ノートを書いた最後の日（tz の日付）と、そこまでの連続日数。"""
+
+    def __init__(self, tz: Optional[tzinfo] = None):
+        self.tz = tz
+        self.last: Optional[date] = None
+        self.run = 0
+
+    def add(self, ts: int):
+        d = datetime.fromtimestamp(ts, self.tz).date()
+        if self.last is not None and d <= self.last:
+            return  # 同じ日の 2 件目（時計が戻った古い日付もここで無視する）
+        self.run = self.run + 1 if self.last is not None and (d - self.last).days == 1 else 1
+        self.last = d
+
+    def current(self, today: date) -> int:
+        """today にノートがあれば連続日数、なければ 0。"""
+        if self.last is not None and (today - self.last).days > 1:
+            # 日付をまたいで途切れていたらここで捨てる（次のノートは 1 日目から）
+            self.last, self.run = None, 0
+        return self.run if self.last == today else 0
+
+
+class LocalLog:
+    def __init__(self, max_records: int = LOCAL_LOG_MAX, tz: Optional[tzinfo] = None):
+        self.max_records = max_records
+        self.recs: Dict[str, List[Any]] = {k: [] for k in KINDS}
+        self.spilled: Counter = Counter()
+        self.study_stats = StudyStats()
+        self.streak = Streak(tz)
+        self._spill = None
+        _LIVE.add(self)
+
+    def add(self, kind: str, **fields) -> Any:
+        for f in ENUM_FIELDS[kind]:
+            fields[f] = sys.intern(fields[f] or "")
+        rec = KINDS[kind](**fields)
+        recs = self.recs[kind]
+        recs.append(rec)
+        if kind == "study":
+            self.study_stats.add(rec)
+        elif kind == "note":
+            self.streak.add(rec.ts)
+        if len(recs) > self.max_records:
+            # 1 件ずつではなく 1/4 ずつまとめて逃がす
+            self._spill_oldest(kind, len(recs) - self.max_records + self.max_records // 4)
+        return rec
+
+    def _spill_oldest(self, kind: str, n: int):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile("w+", encoding="utf-8")
+        self._spill.seek(0, os.SEEK_END)
+        recs = self.recs[kind]
+        for rec in recs[:n]:
+            self._spill.write(json.dumps([kind, list(rec)], ensure_ascii=False) + "\n")
+        self._spill.flush()
+        del recs[:n]
+        self.spilled[kind] += n
+
+    def recent(self, kind: str) -> List[Any]:
+        """メモリ上の記録（古い順）。"""
+        return self.recs[kind]
+
+    def count(self, kind: str) -> int:
+        return self.spilled[kind] + len(self.recs[kind])
+
+    def all(self, kind: str) -> Iterator[Any]:
+        """一時ファイルに逃がした分も含めたすべての記録（古い順）。"""
+        if self.spilled[kind]:
+            cls = KINDS[kind]
+            self._spill.seek(0)
+            for line in self._spill:
+                k, row = json.loads(line)
+                if k == kind:
+                    yield cls(*row)
+        yield from self.recs[kind]
+
+    def __bool__(self) -> bool:
+        return any(self.count(k) for k in KINDS)
+
+    def nbytes(self) -> int:
+        """メモリ上の大きさの見積もり（共有している intern 文字列は数えない）。"""
+        total = sys.getsizeof(self) + sys.getsizeof(self.recs)
+        for kind, recs in self.recs.items():
+            shared = {KINDS[kind]._fields.index(f) for f in ENUM_FIELDS[kind]}
+            total += sys.getsizeof(recs)
+            for rec in recs:
+                total += sys.getsizeof(rec)
+                total += sum(sys.getsizeof(v) for i, v in enumerate(rec) if i not in shared)
+        return total
+
+
+def memory_report() -> Dict[str, Any]:
+    """いま生きている全セッションの LocalLog の大きさ（インスタンスの見積もり用）。"""
+    sizes = sorted(log.nbytes() for log in list(_LIVE))
+    spilled = sum(sum(log.spilled.values()) for log in list(_LIVE))
+    if not sizes:
+        return {"sessions": 0, "total_bytes": 0, "mean_bytes": 0, "p95_bytes": 0, "max_bytes": 0, "spilled_records": 0}
+    return {
+        "sessions": len(sizes),
+        "total_bytes": sum(sizes),
+        "mean_bytes": sum(sizes) // len(sizes),
+        "p95_bytes": sizes[min(len(sizes) - 1, int(len(sizes) * 0.95))],
+        "max_bytes": sizes[-1],
+        "spilled_records": spilled,
+    }
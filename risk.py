@@ -0,0 +1,103 @@
+# risk.py — With You. リスクキーワード判定（生徒アプリ / 管理アプリ共通）
+# 生徒側の classify_risk_level・msg_priority と管理側の相談の並び順（message_priority）が
+# 同じキーワード表・同じ正規化で判定するための共通モジュール。
+# キーワード表は import 時に 1 度だけ 1 本の正規表現にまとめ、本文は 1 パスで走査する
+# （純 Python のオートマトンより C 実装の正規表現エンジンの方が速い）。
+
+from __future__ import annotations
+from typing import Dict, List, Tuple
+import re, unicodedata
+
+# キーワード表や判定ルールを変えたら上げる。保存済みの risk_level・msg_priority がどの版の判定かを記録するため。
+RISK_CLASSIFIER_VERSION = 2
+
+URGENT = "urgent"
+MEDIUM = "medium"
+LOW = "low"
+
+URGENT_KEYWORDS = [
+    # 「終わり」単体は「授業が終わり」のような普通の文にも出るので、言い回しごとに入れる
+    "死にたい", "自殺", "消えたい", "死ぬ", "終わりにしたい", "人生終わり", "人生を終わら", "希死", "殺", "首を",
+    "暴力", "虐待", "いじめられ", "殴られ", "蹴られ",
+    "自傷", "リストカット", "リスカ", "OD", "飛び降り",
+]
+
+MEDIUM_KEYWORDS = [
+    "眠れない", "寝れない", "食べられない", "食欲", "吐き気",
+    "しんどい", "しんど", "助けて", "不安", "落ち込", "つらい", "苦しい",
+    "パニック", "過呼吸", "動悸",
+]
+
+_KATAKANA_TO_HIRAGANA = {c: c - 0x60 for c in range(ord("ァ"), ord("ヶ") + 1)}
+
+
+def normalize_text(text: str) -> str:
+    """NFKC（全角英数・半角カナの統一）→ 小文字 → カタカナをひらがなに。"""
+    s = unicodedata.normalize("NFKC", text or "")
+    return s.lower().translate(_KATAKANA_TO_HIRAGANA)
+
+
+def _kana_insensitive(kw: str) -> str:
+    """ひらがなの 1 文字ずつを [ひカ] のような文字クラスにして、本文側のかな変換を省く。"""
+    out = []
+    for ch in kw:
+        kata = chr(ord(ch) + 0x60)
+        if ord(kata) in _KATAKANA_TO_HIRAGANA:
+            out.append(f"[{ch}{kata}]")
+        else:
+            out.append(re.escape(ch))
+    return "".join(out)
+
+
+def _build_pattern(keywords: List[str]) -> re.Pattern:
+    alts = []
+    heads = set()
+    # 同じ位置から始まる候補は長い方を優先（「しんどい」と「しんど」を二重に数えない）
+    for kw in sorted(keywords, key=len, reverse=True):
+        alt = _kana_insensitive(kw)
+        heads.add(alt[1:3] if alt.startswith("[") else kw[0])
+        if kw.isascii():
+            # 英字キーワード（OD など）は英単語の一部（good 等）には当てない
+            alt = rf"(?<![a-z]){alt}(?![a-z])"
+        alts.append(alt)
+    # 先頭文字の文字クラスで候補位置を先に絞り、先読みの中でキャプチャすることで
+    # 重なり合うヒットも位置ごとにすべて拾う
+    head = "[" + re.escape("".join(sorted(heads))) + "]"
+    return re.compile(r"(?=" + head + r")(?=(" + "|".join(alts) + r"))")
+
+
+_SEVERITY: Dict[str, str] = {}
+for _kw in MEDIUM_KEYWORDS:
+    _SEVERITY[normalize_text(_kw)] = MEDIUM
+for _kw in URGENT_KEYWORDS:
+    _SEVERITY[normalize_text(_kw)] = URGENT
+_PATTERN = _build_pattern(list(_SEVERITY))
+
+
+def find_risk_hits(text: str) -> List[Tuple[str, str]]:
+    """本文中のキーワードをすべて (正規化済みキーワード, 重大度) で返す（出現順）。"""
+    if not text:
+        return []
+    folded = unicodedata.normalize("NFKC", str(text)).lower()
+    hits = []
+    for m in _PATTERN.finditer(folded):
+        kw = m.group(1).translate(_KATAKANA_TO_HIRAGANA)
+        hits.append((kw, _SEVERITY[kw]))
+    return hits
+
+
+def message_priority(text: str) -> str:
+    """本文だけで決める優先度：urgent のキーワードが 1 つでもあれば urgent、medium があれば medium。"""
+    severities = {sev for _, sev in find_risk_hits(text)}
+    if URGENT in severities:
+        return URGENT
+    if MEDIUM in severities:
+        return MEDIUM
+    return LOW
+
+
+def message_priority_batch(messages):
+    """pandas.Series 版の message_priority。同じ本文は 1 度だけ判定する。"""
+    texts = messages.fillna("").astype(str)
+    memo = {t: message_priority(t) for t in texts.unique()}
+    return texts.map(memo)
@@ -0,0 +1,256 @@
+# spool.py — With You. 送信の先行書き込みログ（ディスク上のスプール）
+#
+# 生徒の送信（school_share / consult_msgs）は、Firestore に送る前にまずローカルディスクの
+# 追記専用ログ（spool.log）に 1 行書いて fsync する。ここまで済めば送信は受け付け済みで、
+# Firestore が遅い・つながらない間も内容は失われず、プロセスを再起動しても残る。
+#
+#   spool.log  … 受け付けた送信（seq 昇順、1 行 1 件の JSON）
+#   spool.ack  … コミットできた seq（1 行 1 つ）
+#   spool.dead … 内容が不正でコミットできなかった送信（InvalidWrite。手で確認する用）
+#   metrics.json … 深さ（未送信件数）と遅れ（最古の未送信の経過秒）など
+#
+# 送信は BatchWriter に seq 順で渡す。失敗した（つながらない）ものはログに残したまま
+# retry_sec ごとに古い順にまとめて再送し、その間に来た新しい送信も後ろに並べる。
+# 再送は本体 doc の create（クライアント生成 ID）なので、前回実は書けていたものは
+# BatchWriter が読み直して成功扱いにする（二重にならない）。
+# 1 つのディレクトリを使えるのは 1 プロセスだけ（ロックファイルで排他）。
+
+from __future__ import annotations
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+import json, os, threading, time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from storage import SERVER_TIMESTAMP, Increment, Write
+from writer import BatchWriter, Ticket
+
+COMPACT_BYTES = 1 << 20  # 未送信が 0 件になったとき、ログがこれより大きければ切り詰める
+METRICS_EVERY_SEC = 1.0
+
+
+class InvalidRecord(Exception):
+    """スプールの 1 件が不正でコミットできず、spool.dead に移した。"""
+
+
+# ================== ログの 1 行 ==================
+def _enc(v: Any) -> Any:
+    if isinstance(v, datetime):
+        return {"$dt": v.isoformat()}
+    if isinstance(v, Increment):
+        return {"$inc": v.value}
+    if v is SERVER_TIMESTAMP:
+        return {"$now": True}
+    if isinstance(v, dict):
+        return {k: _enc(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_enc(x) for x in v]
+    return v
+
+
+def _dec(v: Any) -> Any:
+    if isinstance(v, dict):
+        if "$dt" in v:
+            return datetime.fromisoformat(v["$dt"])
+        if "$inc" in v:
+            return Increment(v["$inc"])
+        if "$now" in v:
+            return SERVER_TIMESTAMP
+        return {k: _dec(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_dec(x) for x in v]
+    return v
+
+
+def encode_record(seq: int, at: float, writes: Sequence[Write]) -> str:
+    return json.dumps(
+        {"seq": seq, "at": at, "writes": [[w.op, w.path, _enc(w.data)] for w in writes]},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def decode_record(line: str) -> Dict[str, Any]:
+    r = json.loads(line)
+    r["writes"] = [Write(op, path, _dec(data)) for op, path, data in r["writes"]]
+    return r
+
+
+# ================== スプール ==================
+class Spool:
+    def __init__(self, directory: str, writer: BatchWriter, retry_sec: float = 5.0):
+        self.dir = directory
+        self.writer = writer
+        self.retry_sec = retry_sec
+        self.stats: Counter = Counter()
+        self._lock = threading.RLock()  # 送った直後に結果が返ると _send の中から _done が呼ばれる
+        self._metrics_at = 0.0
+        self._wake = threading.Event()
+        self._pending: Dict[int, Dict[str, Any]] = {}  # seq -> {"at", "writes", "ticket"}
+        self._inflight: set = set()
+        self._retry_at = 0.0  # 失敗したらこの時刻まで新しい送信もログに溜めるだけにする
+        self._last_replay: Optional[Dict[str, Any]] = None
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)  # 相談本文が平文で入るので本人のみ
+        self._lockfile = open(os.path.join(directory, "spool.lock"), "w")
+        if fcntl is not None:
+            # 別プロセスが使っていれば BlockingIOError（呼び出し側はスプール無しで動く）
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._log_path = os.path.join(directory, "spool.log")
+        self._ack_path = os.path.join(directory, "spool.ack")
+        self._load()
+        self._log = open(self._log_path, "a", encoding="utf-8")
+        self._ack = open(self._ack_path, "a", encoding="utf-8")
+        self._write_metrics()
+
+        self._thread = threading.Thread(target=self._run, name="withyou-spool", daemon=True)
+        self._thread.start()
+        if self._pending:
+            self._wake.set()
+
+    # ---------- 起動時：未送信の読み込みと切り詰め ----------
+    def _load(self):
+        acked = set()
+        if os.path.exists(self._ack_path):
+            with open(self._ack_path, encoding="utf-8") as f:
+                acked = {int(line) for line in f if line.strip()}
+        records = []
+        if os.path.exists(self._log_path):
+            with open(self._log_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        r = decode_record(line)
+                    except ValueError:
+                        continue  # 書き込み途中で落ちた最後の行
+                    if r["seq"] not in acked:
+                        records.append(r)
+        # ack を空にする前に落ちた場合でも seq が古い ack と重ならないように
+        self._seq = max([r["seq"] for r in records] + list(acked), default=0)
+        for r in records:
+            self._pending[r["seq"]] = {"at": r["at"], "writes": r["writes"], "ticket": Ticket(r["writes"][0].path)}
+        self.stats["recovered"] += len(records)
+        # 未送信だけを書き直して ack を空にする（一時ファイル → rename で途中で落ちても壊れない）
+        tmp = self._log_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for r in records:
+                f.write(encode_record(r["seq"], r["at"], r["writes"]) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._log_path)
+        open(self._ack_path, "w").close()
+
+    # ---------- 受け付け ----------
+    def submit(self, writes: Sequence[Write]) -> Ticket:
+        """ログに追記して fsync したら返す。戻り値の Ticket はコミットできた時点で ok になる。"""
+        writes = list(writes)
+        ticket = Ticket(writes[0].path)
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            at = time.time()
+            self._log.write(encode_record(seq, at, writes) + "\n")
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._pending[seq] = {"at": at, "writes": writes, "ticket": ticket}
+            self.stats["appended"] += 1
+            # 再送待ちが無ければそのまま送る。あれば順番を守るために後ろに並べて再送を待つ
+            if time.time() >= self._retry_at and len(self._inflight) == len(self._pending) - 1:
+                self._send([seq])
+        return ticket
+
+    def _send(self, seqs: List[int]):
+        """seq 順に BatchWriter に渡す（呼び出し側で _lock を保持）。"""
+        for seq in seqs:
+            self._inflight.add(seq)
+            t = self.writer.submit(self._pending[seq]["writes"])
+            t.add_done_callback(lambda t, seq=seq: self._done(seq, t))
+
+    def _done(self, seq: int, t: Ticket):
+        with self._lock:
+            self._inflight.discard(seq)
+            rec = self._pending.get(seq)
+            if rec is None:
+                return
+            if t.ok or not t.retryable:
+                if not t.ok:
+                    self.stats["dead"] += 1
+                    with open(os.path.join(self.dir, "spool.dead"), "a", encoding="utf-8") as f:
+                        f.write(encode_record(seq, rec["at"], rec["writes"]) + "\n")
+                self._ack.write(f"{seq}\n")
+                self._ack.flush()
+                del self._pending[seq]
+                self.stats["acked"] += 1
+                rec["ticket"]._resolve(bool(t.ok), None if t.ok else InvalidRecord(t.error))
+                if not self._pending:
+                    self._compact()
+            else:
+                self.stats["failed_sends"] += 1
+                self._retry_at = time.time() + self.retry_sec
+            self._write_metrics()
+
+    def _compact(self):
+        """全部送れたらログと ack を空にする（呼び出し側で _lock を保持）。"""
+        if self._log.tell() < COMPACT_BYTES:
+            return
+        # ログを先に空にする（逆順で間に落ちると送信済みを再送することになる。create なので二重にはならないが無駄）
+        self._log.truncate(0)
+        self._ack.truncate(0)
+        self.stats["compactions"] += 1
+
+    # ---------- 再送（バックグラウンドスレッド） ----------
+    def _run(self):
+        while True:
+            wait = self._retry_at - time.time()
+            self._wake.wait(wait if 0 < wait < self.retry_sec else self.retry_sec)
+            self._wake.clear()
+            with self._lock:
+                if time.time() < self._retry_at:
+                    continue
+                todo = sorted(s for s in self._pending if s not in self._inflight)
+                if not todo:
+                    continue
+                self._last_replay = {
+                    "at": time.time(),
+                    "records": len(todo),
+                    "lag_sec": round(time.time() - self._pending[todo[0]]["at"], 3),
+                }
+                self.stats["replays"] += 1
+                self.stats["replayed"] += len(todo)
+                self._send(todo)
+                self._write_metrics()
+
+    # ---------- 指標 ----------
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._metrics()
+
+    def _metrics(self) -> Dict[str, Any]:
+        oldest = min((r["at"] for r in self._pending.values()), default=None)
+        return {
+            "depth": len(self._pending),
+            "inflight": len(self._inflight),
+            "lag_sec": 0.0 if oldest is None else round(time.time() - oldest, 3),
+            "oldest_at": oldest,
+            "log_bytes": self._log.tell(),
+            "last_replay": self._last_replay,
+            **{k: self.stats[k] for k in ("appended", "acked", "recovered", "replays", "replayed", "failed_sends", "dead")},
+        }
+
+    def _write_metrics(self):
+        """metrics.json を置き換える（外から監視する用）。書き換えは 1 秒に 1 回まで、空になったときは必ず。"""
+        now = time.time()
+        if self._pending and now - self._metrics_at < METRICS_EVERY_SEC:
+            return
+        self._metrics_at = now
+        path = os.path.join(self.dir, "metrics.json")
+        m = self._metrics() | {"updated_at": now}
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(m, f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
@@ -0,0 +1,495 @@
+# storage.py — With You. データ保存の差し替え口（生徒アプリ / 管理アプリ共通）
+#
+# 2つのアプリが実際に使っている操作（1件の get / create / set、コレクションへの add、
+# where・order_by・limit・start_after・select を使ったクエリ、バッチコミット、Increment、SERVER_TIMESTAMP、
+# 1件の読み取り＋条件付き更新）だけを
+# Storage にまとめ、実装を
+#   - FirestoreStorage : 本番の Firestore
+#   - MemoryStorage    : プロセス内の dict（負荷試験・ベンチマーク用）
+#   - SQLiteStorage    : ローカルの SQLite ファイル（オフラインで 2 つのアプリを同時に動かす用）
+# から選べるようにする。ローカル実装のクエリは Firestore と同じ意味になるように揃えてある
+# （フィールドが無いドキュメントは where / order_by で除外、同じ値は doc ID 順、カーソルは直前の Doc）。
+#
+# どれを使うかは環境変数 WITHYOU_STORAGE で決める：
+#   未設定 / "firestore"      … Firestore（Secrets の FIREBASE_SERVICE_ACCOUNT）
+#   "memory"                  … MemoryStorage
+#   "sqlite:///path/to/db"    … SQLiteStorage
+
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+import contextlib, copy, operator, os, pickle, sqlite3, threading, uuid
+
+
+class AlreadyExists(Exception):
+    """create したドキュメントがすでに存在する。"""
+
+
+class InvalidWrite(Exception):
+    """書き込み内容そのものが不正（サイズ超過・使えない値など）。やり直しても通らない。"""
+
+
+class Increment:
+    """数値フィールドへの加算（Firestore の Increment 相当）。"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f"Increment({self.value!r})"
+
+
+class _ServerTimestamp:
+    def __repr__(self):
+        return "SERVER_TIMESTAMP"
+
+
+# 書き込んだ側の時計ではなく、保存先がコミットした時刻を入れる（Firestore の SERVER_TIMESTAMP 相当）
+SERVER_TIMESTAMP = _ServerTimestamp()
+
+
+class Write(NamedTuple):
+    """バッチの 1 操作。op は "create"（無いときだけ）/ "set"（上書き）/ "merge"（部分更新）/ "delete"（data は空）。"""
+
+    op: str
+    path: str
+    data: Dict[str, Any]
+
+
+class Doc(NamedTuple):
+    """クエリ結果の 1 件。cursor は start_after にそのまま渡すための実装ごとの値。"""
+
+    id: str
+    data: Dict[str, Any]
+    cursor: Any = None
+
+
+Where = Tuple[str, str, Any]
+
+
+def new_id() -> str:
+    """Firestore の自動 ID と同じ 20 文字の doc ID。"""
+    return uuid.uuid4().hex[:20]
+
+
+def split_path(path: str) -> Tuple[str, str]:
+    """"groups/g/users/u" → ("groups/g/users", "u")"""
+    coll, _, doc_id = path.strip("/").rpartition("/")
+    return coll, doc_id
+
+
+class Storage(ABC):
+    """保存先の共通インターフェース。stats に読み書きの回数（Firestore の課金単位）を数える。"""
+
+    name = "base"
+
+    def __init__(self):
+        self.stats: Counter = Counter()
+
+    @abstractmethod
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        """path の doc を読む。無ければ None。"""
+
+    @abstractmethod
+    def get_many(
+        self, paths: Sequence[str], select: Optional[Sequence[str]] = None
+    ) -> Dict[str, Optional[Dict[str, Any]]]:
+        """paths をまとめて読む（1 回の往復）。select を渡すとそのフィールドだけ返す。"""
+
+    def create(self, path: str, data: Dict[str, Any]) -> None:
+        self.commit([Write("create", path, data)])
+
+    def set(self, path: str, data: Dict[str, Any], merge: bool = False) -> None:
+        self.commit([Write("merge" if merge else "set", path, data)])
+
+    def add(self, coll: str, data: Dict[str, Any]) -> str:
+        doc_id = new_id()
+        self.commit([Write("set", f"{coll}/{doc_id}", data)])
+        return doc_id
+
+    @abstractmethod
+    def commit(self, writes: Sequence[Write]) -> None:
+        """writes をまとめてアトミックに反映する（1 回の往復）。"""
+
+    @abstractmethod
+    def update_if(
+        self, path: str, fn: Callable[[Optional[Dict[str, Any]]], Optional[Dict[str, Any]]]
+    ) -> Optional[Dict[str, Any]]:
+        """path を読み、fn(読んだデータ) が更新を返したときだけ、読んだ値が変わっていなければ書き込む
+        （最上位フィールド単位の更新）。読んだデータ（無ければ None）を返す。更新が無ければ書き込みは発生しない。"""
+
+    @abstractmethod
+    def query(
+        self,
+        coll: str,
+        where: Iterable[Where] = (),
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+        start_after: Optional[Doc] = None,
+        select: Optional[Sequence[str]] = None,
+    ) -> List[Doc]:
+        """coll へのクエリ。結果の cursor はそのまま start_after に渡せる。"""
+
+
+# ================== Firestore ==================
+class FirestoreStorage(Storage):
+    name = "firestore"
+
+    def __init__(self, client):
+        super().__init__()
+        from google.cloud import firestore
+        from google.api_core import exceptions
+
+        self.client = client
+        self._fs = firestore
+        # Conflict のうち AlreadyExists だけ。Aborted（競合による中断）は一時的な障害としてバックオフでやり直す
+        self._exists = exceptions.AlreadyExists
+        self._precondition = exceptions.FailedPrecondition
+        self._invalid = (exceptions.InvalidArgument, exceptions.FailedPrecondition)
+
+    def _data(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        out = {}
+        for k, v in data.items():
+            if isinstance(v, Increment):
+                v = self._fs.Increment(v.value)
+            elif v is SERVER_TIMESTAMP:
+                v = self._fs.SERVER_TIMESTAMP
+            elif isinstance(v, dict):
+                v = self._data(v)
+            out[k] = v
+        return out
+
+    def get(self, path):
+        self.stats["reads"] += 1
+        snap = self.client.document(path).get()
+        return snap.to_dict() if snap.exists else None
+
+    def get_many(self, paths, select=None):
+        self.stats["reads"] += len(paths)
+        refs = [self.client.document(p) for p in paths]
+        out = {p: None for p in paths}
+        for snap in self.client.get_all(refs, field_paths=None if select is None else list(select)):
+            if snap.exists:
+                out[snap.reference.path] = snap.to_dict()
+        return out
+
+    def commit(self, writes):
+        self.stats["commits"] += 1
+        self.stats["writes"] += len(writes)
+        batch = self.client.batch()
+        for w in writes:
+            ref = self.client.document(w.path)
+            if w.op == "create":
+                batch.create(ref, self._data(w.data))
+            elif w.op == "delete":
+                batch.delete(ref)
+            else:
+                batch.set(ref, self._data(w.data), merge=(w.op == "merge"))
+        try:
+            batch.commit()
+        except self._exists as e:
+            raise AlreadyExists(str(e)) from e
+        except self._invalid as e:
+            raise InvalidWrite(str(e)) from e
+
+    def update_if(self, path, fn):
+        # トランザクション（begin / get / commit の 3 往復）の代わりに、読んだ時点の update_time を
+        # 前提条件にした書き込みで同じ「読んだ値のままなら更新」を実現する。更新しなければ 1 往復
+        ref = self.client.document(path)
+        for _ in range(3):
+            snap = ref.get()
+            self.stats["reads"] += 1
+            data = snap.to_dict() if snap.exists else None
+            update = fn(data)
+            if not update:
+                return data
+            self.stats["commits"] += 1
+            self.stats["writes"] += 1
+            try:
+                if snap.exists:
+                    ref.update(self._data(update), option=self.client.write_option(last_update_time=snap.update_time))
+                else:
+                    ref.create(self._data(update))
+                return data
+            except (self._exists, self._precondition):
+                continue  # 読んだ後に別の書き込みがあった。読み直す
+        raise AlreadyExists(path)
+
+    def query(self, coll, where=(), order_by=None, descending=False, limit=None, start_after=None, select=None):
+        q = self.client.collection(coll)
+        for field, op, value in where:
+            q = q.where(field, op, value)
+        if select is not None:
+            q = q.select(list(select))
+        if order_by:
+            q = q.order_by(order_by, direction="DESCENDING" if descending else "ASCENDING")
+        if start_after is not None:
+            q = q.start_after(start_after.cursor)
+        if limit:
+            q = q.limit(limit)
+        docs = [Doc(s.id, s.to_dict(), s) for s in q.stream()]
+        self.stats["queries"] += 1
+        self.stats["reads"] += max(1, len(docs))  # 0 件でも 1 読み取りとして課金される
+        return docs
+
+
+# ================== ローカル実装（メモリ / SQLite） ==================
+_MISSING = object()
+
+_OPS: Dict[str, Callable[[Any, Any], bool]] = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda a, b: a in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+def _field(data: Dict[str, Any], path: str):
+    cur: Any = data
+    for part in path.split("."):
+        if not isinstance(cur, dict) or part not in cur:
+            return _MISSING
+        cur = cur[part]
+    return cur
+
+
+def _project(data: Dict[str, Any], fields: Sequence[str]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for path in fields:
+        v = _field(data, path)
+        if v is _MISSING:
+            continue
+        cur = out
+        parts = path.split(".")
+        for part in parts[:-1]:
+            cur = cur.setdefault(part, {})
+        cur[parts[-1]] = copy.deepcopy(v)
+    return out
+
+
+def _apply(old: Optional[Dict[str, Any]], data: Dict[str, Any], merge: bool) -> Dict[str, Any]:
+    new = dict(old) if (merge and old) else {}
+    for k, v in data.items():
+        if isinstance(v, Increment):
+            base = new.get(k) if merge else None
+            new[k] = (base if isinstance(base, (int, float)) else 0) + v.value
+        elif v is SERVER_TIMESTAMP:
+            new[k] = datetime.now(timezone.utc)
+        elif merge and isinstance(v, dict) and isinstance(new.get(k), dict):
+            new[k] = _apply(new[k], v, True)
+        elif isinstance(v, dict):
+            new[k] = _apply(None, v, False)
+        else:
+            new[k] = copy.deepcopy(v)
+    return new
+
+
+def run_query(
+    items: Iterable[Tuple[str, Dict[str, Any]]],
+    where: Iterable[Where] = (),
+    order_by: Optional[str] = None,
+    descending: bool = False,
+    limit: Optional[int] = None,
+    start_after: Optional[Doc] = None,
+    select: Optional[Sequence[str]] = None,
+) -> List[Doc]:
+    """Firestore と同じ意味のクエリをメモリ上の (id, data) に対して実行する。"""
+    where = list(where)
+    rows = []
+    for doc_id, data in items:
+        ok = True
+        for field, op, value in where:
+            v = _field(data, field)
+            try:
+                ok = v is not _MISSING and _OPS[op](v, value)
+            except TypeError:
+                ok = False
+            if not ok:
+                break
+        if ok and order_by and _field(data, order_by) is _MISSING:
+            ok = False
+        if ok:
+            rows.append((doc_id, data))
+
+    def key(row):
+        return ((_field(row[1], order_by),) if order_by else ()) + (row[0],)
+
+    rows.sort(key=key, reverse=descending)
+    if start_after is not None:
+        cur = start_after.cursor
+        rows = [r for r in rows if (key(r) < cur if descending else key(r) > cur)]
+    if limit:
+        rows = rows[:limit]
+    return [
+        Doc(doc_id, _project(data, select) if select is not None else copy.deepcopy(data), key((doc_id, data)))
+        for doc_id, data in rows
+    ]
+
+
+class LocalStorage(Storage):
+    """コレクションパスごとに {doc_id: data} を持つローカル実装の共通部分。"""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+
+    # 実装ごとに差し替える 3 つ
+    @abstractmethod
+    def _load_one(self, coll: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        """1 件読む。無ければ None。"""
+
+    @abstractmethod
+    def _load_coll(self, coll: str) -> Iterable[Tuple[str, Dict[str, Any]]]:
+        """coll の (doc_id, data) を全部返す。"""
+
+    @abstractmethod
+    def _store(self, puts: List[Tuple[str, str, Dict[str, Any]]]) -> None:
+        """(coll, doc_id, data) をまとめて書く（丸ごと置き換え。data が None なら削除）。"""
+
+    def _txn(self):
+        """commit の読み取り〜書き込みを 1 つのトランザクションにする（SQLite 用）。"""
+        return contextlib.nullcontext()
+
+    def get(self, path):
+        with self.lock:
+            self.stats["reads"] += 1
+            data = self._load_one(*split_path(path))
+            return copy.deepcopy(data)
+
+    def get_many(self, paths, select=None):
+        with self.lock:
+            self.stats["reads"] += len(paths)
+            out = {p: self._load_one(*split_path(p)) for p in paths}
+            if select is not None:
+                return {p: None if d is None else _project(d, select) for p, d in out.items()}
+            return copy.deepcopy(out)
+
+    def commit(self, writes):
+        with self.lock, self._txn():
+            self.stats["commits"] += 1
+            self.stats["writes"] += len(writes)
+            pending: Dict[Tuple[str, str], Optional[Dict[str, Any]]] = {}
+            for w in writes:
+                coll, doc_id = split_path(w.path)
+                key = (coll, doc_id)
+                old = pending[key] if key in pending else self._load_one(coll, doc_id)
+                if w.op == "create" and old is not None:
+                    raise AlreadyExists(w.path)
+                if w.op == "delete":
+                    pending[key] = None
+                    continue
+                pending[key] = _apply(old, w.data, merge=(w.op == "merge"))
+            self._store([(coll, doc_id, data) for (coll, doc_id), data in pending.items()])
+
+    def update_if(self, path, fn):
+        with self.lock, self._txn():
+            self.stats["reads"] += 1
+            coll, doc_id = split_path(path)
+            data = self._load_one(coll, doc_id)
+            update = fn(copy.deepcopy(data))
+            if update:
+                self.stats["commits"] += 1
+                self.stats["writes"] += 1
+                self._store([(coll, doc_id, _apply(data, update, merge=True))])
+            return copy.deepcopy(data)
+
+    def query(self, coll, where=(), order_by=None, descending=False, limit=None, start_after=None, select=None):
+        with self.lock:
+            docs = run_query(self._load_coll(coll), where, order_by, descending, limit, start_after, select)
+            self.stats["queries"] += 1
+            self.stats["reads"] += max(1, len(docs))
+            return docs
+
+
+class MemoryStorage(LocalStorage):
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self.colls: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    def _load_one(self, coll, doc_id):
+        return self.colls.get(coll, {}).get(doc_id)
+
+    def _load_coll(self, coll):
+        return list(self.colls.get(coll, {}).items())
+
+    def _store(self, puts):
+        for coll, doc_id, data in puts:
+            if data is None:
+                self.colls.get(coll, {}).pop(doc_id, None)
+            else:
+                self.colls.setdefault(coll, {})[doc_id] = data
+
+
+class SQLiteStorage(LocalStorage):
+    """1 ドキュメント = 1 行（pickle）。datetime などの型もそのまま戻る。"""
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs (coll TEXT NOT NULL, id TEXT NOT NULL, data BLOB NOT NULL,"
+            " PRIMARY KEY (coll, id))"
+        )
+
+    def _load_one(self, coll, doc_id):
+        row = self.conn.execute("SELECT data FROM docs WHERE coll = ? AND id = ?", (coll, doc_id)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _load_coll(self, coll):
+        rows = self.conn.execute("SELECT id, data FROM docs WHERE coll = ?", (coll,)).fetchall()
+        return [(doc_id, pickle.loads(blob)) for doc_id, blob in rows]
+
+    def _store(self, puts):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO docs (coll, id, data) VALUES (?, ?, ?)",
+            [(coll, doc_id, pickle.dumps(data)) for coll, doc_id, data in puts if data is not None],
+        )
+        self.conn.executemany(
+            "DELETE FROM docs WHERE coll = ? AND id = ?",
+            [(coll, doc_id) for coll, doc_id, data in puts if data is None],
+        )
+
+    @contextlib.contextmanager
+    def _txn(self):
+        # 別プロセス（もう一方のアプリ）と同じファイルを使うので、確認と書き込みの間に割り込ませない
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+
+# ================== 選択 ==================
+_LOCAL: Dict[str, LocalStorage] = {}
+_LOCAL_LOCK = threading.Lock()
+
+
+def local_storage_from_env() -> Optional[LocalStorage]:
+    """WITHYOU_STORAGE がローカル実装を指していればそれを返す（同じ指定なら同じインスタンス）。"""
+    url = (os.environ.get("WITHYOU_STORAGE") or "").strip()
+    if not url or url == "firestore":
+        return None
+    with _LOCAL_LOCK:
+        if url not in _LOCAL:
+            if url == "memory":
+                _LOCAL[url] = MemoryStorage()
+            elif url.startswith("sqlite://"):
+                _LOCAL[url] = SQLiteStorage(url[len("sqlite://"):] or ":memory:")
+            else:
+                raise ValueError(f"WITHYOU_STORAGE の指定が不正です: {url}")
+        return _LOCAL[url]
@@ -0,0 +1,253 @@
+# writer.py — With You. 書き込みのまとめ役（write-behind）
+#
+# 生徒アプリの「送る」はセッションごとに 1 回ずつ Firestore に往復していた。
+# BatchWriter はプロセス内の全セッションの書き込みをキューに溜め、
+#   - 最大 500 Write（Firestore のバッチ上限）まで
+#   - 最初の 1 件から max_delay 秒待つか、上限に達したら
+# 1 回のバッチコミットにまとめる。朝の一斉チェックインが数回のコミットで済む。
+#
+# 1 件（Item）は複数の Write をまとめたもの（本体 + 日次ロールアップの加算など）で、
+# Item はバッチをまたいで分割しない。先頭の Write は必ず本体 doc の create にしておく。
+# 同じ doc への merge（日次ロールアップの Increment）はバッチ内で 1 つに畳んでから送る。
+# 失敗してやり直すときは先に本体 doc の有無を確かめ、すでにあるもの（前回のコミットが
+# 実は通っていたもの）は成功扱いにして外すので、加算が二重にならない。
+#
+# 失敗の扱い：
+#   InvalidWrite  … その Item 自体が不正。バッチを半分ずつに分けて不正なものだけ失敗にする
+#   AlreadyExists … 本体 doc の有無を確かめ直してすぐやり直す（Firestore の Aborted などは「それ以外」）
+#   それ以外      … 一時的な障害とみなし、ジッター付き指数バックオフでやり直す
+
+from __future__ import annotations
+from collections import Counter, deque
+from typing import Callable, Deque, List, Optional, Sequence
+import atexit, random, threading, time
+
+from storage import AlreadyExists, Increment, InvalidWrite, Storage, Write
+
+MAX_BATCH_WRITES = 500
+
+
+def _fold(old: dict, new: dict) -> dict:
+    out = dict(old)
+    for k, v in new.items():
+        if isinstance(v, Increment) and isinstance(out.get(k), Increment):
+            out[k] = Increment(out[k].value + v.value)
+        elif isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = _fold(out[k], v)
+        else:
+            out[k] = v
+    return out
+
+
+def coalesce(writes: Sequence[Write]) -> List[Write]:
+    """同じ doc への merge をまとめて 1 Write にする（同じ日次ロールアップへの加算など）。
+    間に同じ doc への create / set がある場合はまとめない。"""
+    out: List[Write] = []
+    last: dict = {}  # path -> out 内の位置
+    for w in writes:
+        i = last.get(w.path)
+        if w.op == "merge" and i is not None and out[i].op == "merge":
+            out[i] = Write("merge", w.path, _fold(out[i].data, w.data))
+        else:
+            last[w.path] = len(out)
+            out.append(w)
+    return out
+
+
+class Ticket:
+    """投入した 1 件の結果。done になったら ok / error が決まる。"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.ok: Optional[bool] = None
+        self.error: Optional[str] = None
+        self.retryable = True  # False なら内容が不正で、やり直しても通らない
+        self.submitted_at = time.time()
+        self._done = threading.Event()
+        self._callbacks: List[Callable[[Ticket], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[bool]:
+        """結果を待つ。timeout までに決まらなければ None。"""
+        self._done.wait(timeout)
+        return self.ok
+
+    def add_done_callback(self, fn: Callable[[Ticket], None]):
+        """結果が決まったら fn(ticket) を呼ぶ（決まっていればすぐ呼ぶ）。コミット側のスレッドで呼ばれる。"""
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _resolve(self, ok: bool, error: Optional[BaseException] = None):
+        with self._lock:
+            self.ok = ok
+            self.error = None if error is None else f"{type(error).__name__}: {error}"
+            self.retryable = not isinstance(error, InvalidWrite)
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class Item:
+    def __init__(self, writes: Sequence[Write]):
+        if not writes or writes[0].op != "create":
+            raise ValueError("先頭の Write は本体 doc の create にしてください")
+        if len(writes) > MAX_BATCH_WRITES:
+            raise ValueError(f"1 件の Write は {MAX_BATCH_WRITES} 個までです")
+        self.writes = list(writes)
+        self.ticket = Ticket(writes[0].path)
+
+
+class BatchWriter:
+    """全セッション共通の書き込みキュー。バックグラウンドのスレッド 1 本がコミットする。"""
+
+    def __init__(
+        self,
+        db: Storage,
+        max_writes: int = MAX_BATCH_WRITES,
+        max_delay: float = 0.2,
+        max_attempts: int = 6,
+        backoff_base: float = 0.2,
+        backoff_max: float = 5.0,
+    ):
+        self.db = db
+        self.max_writes = min(max_writes, MAX_BATCH_WRITES)
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats: Counter = Counter()
+        self._queue: Deque[Item] = deque()
+        self._queued_writes = 0
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="withyou-batch-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush, 10.0)
+
+    # ---------- 投入側（各セッションのスクリプトスレッド） ----------
+    def submit(self, writes: Sequence[Write]) -> Ticket:
+        item = Item(writes)
+        with self._cond:
+            self._queue.append(item)
+            self._queued_writes += len(item.writes)
+            self.stats["submitted"] += 1
+            self._cond.notify_all()
+        return item.ticket
+
+    def pending(self) -> int:
+        """キューに残っている件数 + コミット中の件数。"""
+        with self._cond:
+            return len(self._queue) + self._inflight
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """キューが空になりコミット中のものも終わるまで待つ。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue or self._inflight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # ---------- コミット側（バックグラウンドスレッド） ----------
+    def _take(self) -> List[Item]:
+        """キューの先頭から max_writes に収まるだけ取り出す（呼び出し側で _cond を保持）。"""
+        batch: List[Item] = []
+        n = 0
+        while self._queue and n + len(self._queue[0].writes) <= self.max_writes:
+            item = self._queue.popleft()
+            n += len(item.writes)
+            batch.append(item)
+        self._queued_writes -= n
+        self._inflight += len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # 最初の 1 件から max_delay だけ待って、同時に来た送信をまとめる
+                deadline = time.monotonic() + self.max_delay
+                while self._queued_writes < self.max_writes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take()
+            try:
+                self._commit(batch)
+            except Exception as e:  # ここで落ちるとスレッドが止まるので、結果を返して続ける
+                for item in batch:
+                    if not item.ticket.done:
+                        item.ticket._resolve(False, e)
+            finally:
+                with self._cond:
+                    self._inflight -= len(batch)
+                    self._cond.notify_all()
+
+    def _backoff(self, attempt: int) -> float:
+        """フルジッター付き指数バックオフ（同時に失敗したプロセスが一斉にやり直さないように）。"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _drop_applied(self, batch: List[Item]) -> List[Item]:
+        """本体 doc がすでにある Item は前回のコミットで書けているので成功にして外す。"""
+        found = self.db.get_many([item.ticket.key for item in batch])
+        rest = []
+        for item in batch:
+            if found.get(item.ticket.key) is not None:
+                self.stats["committed"] += 1
+                self.stats["recovered"] += 1
+                item.ticket._resolve(True)
+            else:
+                rest.append(item)
+        return rest
+
+    def _commit(self, batch: List[Item]):
+        last_error: Optional[BaseException] = None
+        for attempt in range(self.max_attempts):
+            try:
+                if attempt:
+                    batch = self._drop_applied(batch)
+                    if not batch:
+                        return
+                self.db.commit(coalesce([w for item in batch for w in item.writes]))
+            except InvalidWrite as e:
+                self.stats["invalid"] += 1
+                if len(batch) == 1:
+                    self.stats["failed"] += 1
+                    batch[0].ticket._resolve(False, e)
+                else:
+                    # 半分ずつに分けて不正な Item を絞り込む（1 件だけなら log2(n) 回ほどで済む）
+                    mid = len(batch) // 2
+                    self._commit(batch[:mid])
+                    self._commit(batch[mid:])
+                return
+            except AlreadyExists as e:
+                last_error = e
+                self.stats["retries"] += 1
+                continue
+            except Exception as e:
+                last_error = e
+                self.stats["retries"] += 1
+                if attempt + 1 < self.max_attempts:
+                    time.sleep(self._backoff(attempt))
+                continue
+            self.stats["commits"] += 1
+            self.stats["committed"] += len(batch)
+            for item in batch:
+                item.ticket._resolve(True)
+            return
+        self.stats["failed"] += len(batch)
+        for item in batch:
+            item.ticket._resolve(False, last_error)